@@ -0,0 +1,230 @@
+#! python3
+"""Microbenchmarks for the parsing layer of itunesapi.
+
+Generates synthetic search and lookup responses, then measures JSON decoding
+plus record construction, peak memory and memory per result, without any
+network access. Results can be written to a JSON file and compared with an
+earlier run.
+"""
+import sys
+import argparse
+import json
+import random
+import statistics
+import time
+import tracemalloc
+import platform
+
+import itunesapi
+
+__version__ = "1.8"
+
+sizes_default = [10, 50, 200, 1000, 5000]
+
+
+def _artwork(rnd):
+    return "https://is%d-ssl.mzstatic.com/image/thumb/Music%d/v4/%02x/%02x/source/100x100bb.jpg" % (
+        rnd.randint(1, 5), rnd.randint(100, 130), rnd.randint(0, 255), rnd.randint(0, 255))
+
+
+def _collection(rnd, collectionId):
+    item = {
+        "wrapperType": "collection",
+        "collectionType": "Album",
+        "artistId": rnd.randint(1, 10 ** 9),
+        "collectionId": collectionId,
+        "artistName": "Artist %d" % rnd.randint(1, 10 ** 6),
+        "collectionName": "Album name %d with a somewhat longer title" % collectionId,
+        "collectionViewUrl": "https://music.apple.com/us/album/x/%d?uo=4" % collectionId,
+        "artworkUrl60": _artwork(rnd).replace("100x100", "60x60"),
+        "artworkUrl100": _artwork(rnd),
+        "collectionPrice": 9.99,
+        "collectionExplicitness": "notExplicit",
+        "trackCount": rnd.randint(1, 30),
+        "country": "USA",
+        "currency": "USD",
+        "primaryGenreName": rnd.choice(["Rock", "Pop", "Reggae", "Jazz"])}
+    # Optional keys are missing in some responses
+    if rnd.random() < 0.8:
+        item["releaseDate"] = "20%02d-01-01T08:00:00Z" % rnd.randint(0, 23)
+    if rnd.random() < 0.7:
+        item["copyright"] = "℗ 20%02d Some Record Label" % rnd.randint(0, 23)
+    return item
+
+
+def _track(rnd, collection, number):
+    item = {
+        "wrapperType": "track",
+        "kind": "song",
+        "artistId": collection["artistId"],
+        "collectionId": collection["collectionId"],
+        "trackId": rnd.randint(1, 10 ** 10),
+        "artistName": collection["artistName"],
+        "collectionName": collection["collectionName"],
+        "trackName": "Track title %d" % number,
+        "previewUrl": "https://audio-ssl.itunes.apple.com/preview/%d.m4a" % number,
+        "artworkUrl100": collection["artworkUrl100"],
+        "trackCount": collection["trackCount"],
+        "trackNumber": number,
+        "discCount": 1,
+        "discNumber": 1,
+        "trackTimeMillis": rnd.randint(60000, 400000),
+        "primaryGenreName": collection["primaryGenreName"]}
+    if "releaseDate" in collection:
+        item["releaseDate"] = collection["releaseDate"]
+    if rnd.random() < 0.3:
+        item["collectionArtistName"] = "Various Artists"
+    return item
+
+
+def albumSearchPayload(rnd, size):
+    return {"resultCount": size,
+            "results": [_collection(rnd, 1000 + i) for i in range(size)]}
+
+
+def songSearchPayload(rnd, size):
+    results = []
+    for i in range(size):
+        collection = _collection(rnd, 1000 + i)
+        if rnd.random() < 0.1:
+            # Mixed wrapperType, these are skipped by the parser
+            results.append(collection)
+        else:
+            results.append(_track(rnd, collection, rnd.randint(1, 20)))
+    return {"resultCount": size, "results": results}
+
+
+def lookupPayload(rnd, size):
+    collection = _collection(rnd, 1000)
+    numbers = list(range(1, size))
+    rnd.shuffle(numbers)
+    results = [collection] + [_track(rnd, collection, n) for n in numbers]
+    return {"resultCount": size, "results": results}
+
+
+cases = {
+    "album_search": (albumSearchPayload, itunesapi._parseAlbums),
+    "song_search": (songSearchPayload, itunesapi._parseSongs),
+    "track_lookup": (lookupPayload, itunesapi._parseTracks),
+}
+
+
+def benchmark(name, size, repeat, seed=0):
+    makePayload, parse = cases[name]
+    raw = json.dumps(makePayload(random.Random(seed), size))
+    dimensions = (600, 600, 'bb')
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        records = parse(json.loads(raw), dimensions)
+        timings.append(time.perf_counter() - start)
+    count = len(records)
+    del records
+
+    tracemalloc.start()
+    data = json.loads(raw)
+    records = parse(data, dimensions)
+    peak = tracemalloc.get_traced_memory()[1]
+    # Memory still held by the records once the decoded response is gone
+    del data
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+
+    return {
+        "case": name,
+        "size": size,
+        "results": count,
+        "payloadBytes": len(raw),
+        "repeat": repeat,
+        "minSeconds": min(timings),
+        "medianSeconds": statistics.median(timings),
+        "microsecondsPerResult": min(timings) * 1e6 / max(1, count),
+        "peakBytes": peak,
+        "retainedBytes": retained,
+        "bytesPerResult": retained / max(1, count),
+    }
+
+
+def compare(current, previous):
+    old = {(r["case"], r["size"]): r for r in previous["benchmarks"]}
+    for r in current["benchmarks"]:
+        key = (r["case"], r["size"])
+        if key not in old:
+            continue
+        o = old[key]
+        print("%-14s %6d  time %+6.1f%%  peak %+6.1f%%  bytes/result %+6.1f%%" % (
+            key[0], key[1],
+            100.0 * (r["minSeconds"] / o["minSeconds"] - 1),
+            100.0 * (r["peakBytes"] / max(1, o["peakBytes"]) - 1),
+            100.0 * (r["bytesPerResult"] / max(1, o["bytesPerResult"]) - 1)))
+
+
+def main(args):
+    report = {
+        "itunesapi": itunesapi.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "benchmarks": []}
+
+    print("%-14s %6s %8s %10s %12s %12s %10s" % (
+        "case", "size", "results", "min ms", "us/result", "peak KiB", "B/result"))
+    for name in args.cases:
+        for size in args.sizes:
+            # Fewer repetitions for the large payloads
+            repeat = max(3, args.repeat * 200 // max(size, 200))
+            r = benchmark(name, size, repeat)
+            report["benchmarks"].append(r)
+            print("%-14s %6d %8d %10.3f %12.2f %12.1f %10.0f" % (
+                name, size, r["results"], r["minSeconds"] * 1000,
+                r["microsecondsPerResult"], r["peakBytes"] / 1024, r["bytesPerResult"]))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+        print("Results written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        print("")
+        print("Compared to %s (%s):" % (args.compare, previous.get("timestamp", "?")))
+        compare(report, previous)
+
+    return 0
+
+
+if __name__ == "__main__":
+    # Arguments
+    parser = argparse.ArgumentParser(
+        description='Benchmark decoding and parsing of iTunes API responses')
+    parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=sizes_default,
+        help='Number of results per payload')
+    parser.add_argument(
+        '--cases',
+        nargs='+',
+        choices=list(cases),
+        default=list(cases),
+        help='Which parsers to benchmark')
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=20,
+        help='Repetitions for small payloads')
+    parser.add_argument(
+        '-o',
+        dest='output',
+        help='Write the results as JSON to this file')
+    parser.add_argument(
+        '--compare',
+        help='Compare with the results in this JSON file from an earlier run')
+    args = parser.parse_args()
+
+    sys.exit(main(args))
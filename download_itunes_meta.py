@@ -1,15 +1,14 @@
 #! python3
 import os
 import subprocess
-import urllib.request
 import argparse
 import time
 import re
 import platform
 import ctypes
 
-from fileutils import asciiString, getStuff, setStuff, getAlbumInfoString, getSongInfoString, getTrackInfoString, getBasicAlbumData
-from itunesapi import iTunesGetTracks, iTunesFindSong, iTunesFindAlbum
+from fileutils import asciiString, TagSession, commitMany, normalizeArtwork, ArtworkPolicy, setArtworkPolicy, getAlbumInfoString, getSongInfoString, getTrackInfoString, getBasicAlbumData
+from itunesapi import iTunesGetTracksComplete, iTunesFindAlbum, setCache, SqliteCache, knownEmptyCountries, Prefetcher, StoreIndex, setStoreIndex
 
 __version__ = "1.8"
 
@@ -17,6 +16,7 @@ _colorEnd = '\033[0m'
 
 try_countries = ["us", "ru", "fr", "jm", "jp", "ar", "br", "no", "de", "es"]
 country_default = "us"
+prefetch_count = 3
 
 class Color:
     green = '\033[92m'
@@ -68,9 +68,49 @@ def initColor(enabled=True):
         kernel32.SetConsoleMode(stdOut, consoleMode)
 
 
+def openSession(filename, color=True):
+    try:
+        return TagSession(filename)
+    except BaseException:
+        cprint("Could not read %s" % filename, Color.redBG, color)
+        return None
+
+
+def printProgress(index, total, result):
+    print(" * ", result["filename"])
+    if result["error"]:
+        print(" - Failed. %s" % result["error"])
+    elif not result["written"]:
+        print(" - Unchanged.")
+    elif result["save"] and result["save"]["inPlace"] is False:
+        print(" - Done. Rewritten, %d bytes moved" % result["save"]["movedBytes"])
+    else:
+        print(" - Done.")
+
+
 def main(args):
+    prefetcher = Prefetcher()
+    try:
+        return tagAlbum(args, prefetcher)
+    finally:
+        # Do not wait for prefetches of albums that were not selected
+        prefetcher.close()
+
+
+def tagAlbum(args, prefetcher):
     initColor(args.color)
 
+    if args.cache:
+        setCache(SqliteCache(args.cache))
+    if args.artworkSize:
+        setArtworkPolicy(ArtworkPolicy(maxSize=args.artworkSize, maxBytes=args.artworkBytes * 1024))
+    else:
+        setArtworkPolicy(None)
+    storeIndex = None
+    if args.storeIndex:
+        storeIndex = StoreIndex(args.storeIndex)
+        setStoreIndex(storeIndex)
+
     if args.write:
         cprint("++++Writing Mode++++", Color.red, args.color)
     else:
@@ -90,13 +130,20 @@ def main(args):
         cprint("No .mp3 or .m4a files found!", Color.redBG, args.color)
         return
 
-    # Walk mp3s
-    i = 1
+    # Walk mp3s, every file is parsed once and the session is reused for comparing and writing
+    sessions = []
+    oldmetadata = None
     for name in mp3s:
-        if 1 == i:
-            oldmetadata = getStuff(mp3s[0])  # output first file for debug
+        session = openSession(name, args.color)
+        sessions.append(session)
+        if oldmetadata is None and session is not None:
+            # output first readable file for debug
+            oldmetadata = session.stuff(loud=True)
         print(" * ", os.path.basename(name))
-        i += 1
+
+    if oldmetadata is None:
+        cprint("None of the files could be read!", Color.redBG, args.color)
+        return
 
     # Search on iTunes
     albuminfo, guess = getAlbumInfoString(oldmetadata, mp3s)
@@ -115,7 +162,7 @@ def main(args):
         query = input("['%s']=" % guess)
         if not query:
             query = guess
-        query = query.replace("-", " ").replace("  ", " ").strip()
+        query = query.strip()
         if not query or query == 'q':
             print("No search string provided")
             return
@@ -131,14 +178,14 @@ def main(args):
 
         albums = iTunesFindAlbum(query, country=country)
         if len(albums) == 0:
-            countries = try_countries[:]
-            print("Trying stores in other countries...", end=" ")
-            while len(albums) == 0 and len(countries):
-                cc = countries.pop()
-                print("[%s]" % cc, end=" ")
-                albums = iTunesFindAlbum(query, country=country)
-            print("")
+            # Skip stores that are already known to have nothing for this query
+            empty = knownEmptyCountries(query, "album", try_countries)
+            countries = [cc for cc in try_countries if cc != country and cc not in empty]
+            print("Trying stores in other countries... %s" %
+                  " ".join("[%s]" % cc for cc in countries))
+            albums = iTunesFindAlbum(query, country=countries, firstMatch=True)
             if len(albums) > 0:
+                cc = albums[0]['country']
                 print(colorize("Found %d results in [%s] store" % (
                     len(albums), cc), color=Color.yellowBG, enabled=args.color))
                 country = cc
@@ -161,6 +208,13 @@ def main(args):
                                 album['name'], enabled=args.color),
                  colorize("(%d tracks)" % album['totalTracks'], color=Color.greenBG, enabled=args.color) if albumdata['totalTracks'] == album['totalTracks'] else "(%d tracks)" % album['totalTracks']))
 
+        # Download the most likely albums while the user is choosing,
+        # albums with the same number of tracks first
+        prefetcher.cancel()
+        prefetcher.prefetch(
+            sorted(albums, key=lambda album: album['totalTracks'] != albumdata['totalTracks']),
+            prefetch_count, country, artwork=args.write)
+
         while True:
             val = input('Select your album: ')
             if val == 'q' or val == '0':
@@ -186,22 +240,22 @@ def main(args):
                 except AssertionError:
                     print("Wtf?!")
 
+    # The other albums are not needed anymore
+    prefetcher.cancel(keep=selectedAlbum)
+
     print("Downloading data...")
     # Download selected album data from itunes
-    selectedTracks = iTunesGetTracks(
+    selectedTracks = prefetcher.tracks(
         selectedAlbum["collectionId"], country=country)
 
     if len(selectedTracks) != selectedAlbum['totalTracks']:
         cprint("!!! Expected %d tracks in album but iTunes API provided %d tracks" % (
             selectedAlbum['totalTracks'], len(selectedTracks)), Color.redBG, args.color)
-        countries = try_countries[:]
-        print("Trying stores in other countries...", end=" ")
-        while len(selectedTracks) != selectedAlbum['totalTracks'] and len(countries):
-            cc = countries.pop()
-            print("[%s]" % cc, end=" ")
-            selectedTracks = iTunesGetTracks(
-                selectedAlbum["collectionId"], country=cc)
-        print("")
+        print("Trying stores in other countries...")
+        # Uses the store index to go directly to a store that is known to have all tracks
+        selectedTracks, cc = iTunesGetTracksComplete(
+            selectedAlbum["collectionId"], selectedAlbum['totalTracks'],
+            country=country, countries=try_countries)
         if len(selectedTracks) == selectedAlbum['totalTracks']:
             print(colorize("Found %d tracks in [%s] store" % (
                 len(selectedTracks), cc), color=Color.yellowBG, enabled=args.color))
@@ -209,6 +263,9 @@ def main(args):
         else:
             print("No success in other countries either")
 
+    if storeIndex is not None:
+        storeIndex.save()
+
     if len(selectedTracks) == 0:
         cprint("Aborting.", Color.redBG, args.color)
         if args.sleep:
@@ -220,7 +277,7 @@ def main(args):
 
     # Compare tracks with itunes
     for i, name in enumerate(mp3s[0:min(len(mp3s), len(selectedTracks))]):
-        trackinfo = getTrackInfoString(getStuff(name, loud=False))
+        trackinfo = getTrackInfoString(sessions[i].metadata) if sessions[i] else ""
         if not trackinfo:
             trackinfo = os.path.basename(name)
         print("File:   %s" % trackinfo)
@@ -245,8 +302,7 @@ def main(args):
     if os.path.exists('folder.jpg'):
         if args.write:
             # Replace folder.jpg
-            urllib.request.urlretrieve(
-                selectedAlbum['image'], '_newfolder.jpg')
+            prefetcher.saveArtwork(selectedAlbum['image'], '_newfolder.jpg')
             if os.path.exists('_newfolder.jpg'):
                 try:
                     os.remove('folder.jpg')
@@ -262,10 +318,12 @@ def main(args):
                     subprocess.check_call(["attrib", "+H", "+R", 'folder.jpg'])
 
     elif args.write:
-        urllib.request.urlretrieve(selectedAlbum['image'], 'folder.jpg')
+        prefetcher.saveArtwork(selectedAlbum['image'], 'folder.jpg')
 
     if os.path.exists('folder.jpg'):
-        artwork = open('folder.jpg', 'rb').read()
+        # folder.jpg keeps the original, the embedded copy fits the artwork policy
+        artwork = normalizeArtwork(open('folder.jpg', 'rb').read())
+    prefetcher.close()
 
     # Walk mp3s and set metadata
     if args.write:
@@ -274,7 +332,8 @@ def main(args):
     metadata = {}
     tracks = []  # For batch file
     for i, filename in enumerate(mp3s):
-        print(" * ", filename)
+        if not args.write:
+            print(" * ", filename)
 
         trackdata = {
             "title": selectedTracks[i]['name'],
@@ -286,12 +345,15 @@ def main(args):
             "date": selectedAlbum["date"],
             "genre": selectedAlbum["genre"]
         }
-        stuff = setStuff(
-            filename=filename,
-            artwork=artwork,
-            write=args.write,
-            clean=args.clean,
-            **trackdata)
+        session = sessions[i]
+        if session is None:
+            continue
+        session.set(artwork=artwork, clean=args.clean, **trackdata)
+        if not args.write:
+            # Preview of what would be written
+            for change in session.diff():
+                print("     %s" % str(change)[:100])
+        stuff = session.audio
         metadata.update(stuff)
 
         if 'TIT2' in stuff:
@@ -309,6 +371,11 @@ def main(args):
                         stuff['\xa9ART'][0] if '\xa9ART' in stuff else '',
                         stuff['\xa9nam'][0] if '\xa9nam' in stuff else '')])
 
+    if args.write:
+        # Save the files in parallel, reported in the order of the files
+        commitMany([session for session in sessions if session is not None],
+                   workers=args.workers, progress=printProgress)
+
     # Report
     print("")
     print("++++Report++++")
@@ -372,6 +439,33 @@ if __name__ == "__main__":
         const=True,
         default=False,
         help='Sleep 5 seconds at the end of the script to keep the console window open on Windows')
+    parser.add_argument(
+        '--cache',
+        dest='cache',
+        default=None,
+        help='Cache iTunes API responses in this sqlite file')
+    parser.add_argument(
+        '--store-index',
+        dest='storeIndex',
+        default=None,
+        help='JSON file that records in which country stores albums are complete')
+    parser.add_argument(
+        '--artwork-size',
+        dest='artworkSize',
+        type=int,
+        default=1000,
+        help='Maximum width and height of the embedded artwork, 0 embeds the original')
+    parser.add_argument(
+        '--artwork-kb',
+        dest='artworkBytes',
+        type=int,
+        default=200,
+        help='Maximum size of the embedded artwork in KiB')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Number of files that are written at the same time')
     parser.add_argument(
         '--no-color',
         dest='color',
@@ -2,10 +2,10 @@
 import os
 import argparse
 import time
-import urllib.request
+import urllib.parse
 
-from fileutils import asciiString, getStuff, setStuff, getSongInfoString, getBasicTrackData
-from itunesapi import iTunesFindSong
+from fileutils import asciiString, TagSession, normalizeArtwork, ArtworkPolicy, setArtworkPolicy, getSongInfoString, getBasicTrackData
+from itunesapi import iTunesFindSong, setCache, SqliteCache, knownEmptyCountries, fetchArtwork
 from download_itunes_meta import initColor, colorize, cprint, Color, highlightMatch, try_countries, country_default
 
 __version__ = "1.8"
@@ -14,6 +14,13 @@ __version__ = "1.8"
 def main(args):
     initColor(args.color)
 
+    if args.cache:
+        setCache(SqliteCache(args.cache))
+    if args.artworkSize:
+        setArtworkPolicy(ArtworkPolicy(maxSize=args.artworkSize, maxBytes=args.artworkBytes * 1024))
+    else:
+        setArtworkPolicy(None)
+
     if args.write:
         cprint("++++Writing Mode++++", Color.red, args.color)
     else:
@@ -25,7 +32,8 @@ def main(args):
     mp3 = os.path.abspath(args.filename)
 
     # Walk mp3s
-    oldmetadata = getStuff(mp3)  # output first file for debug
+    session = TagSession(mp3)  # parsed once, reused for writing
+    oldmetadata = session.stuff(loud=True)  # output first file for debug
     print(" * ", os.path.basename(mp3))
 
     # Search on iTunes
@@ -55,7 +63,7 @@ def main(args):
         query = input("['%s']=" % guess)
         if not query:
             query = guess
-        query = query.replace("-", " ").replace("  ", " ").strip()
+        query = query.strip()
         if not query or query == 'q':
             print("No search string provided")
             return
@@ -71,14 +79,14 @@ def main(args):
 
         songs = iTunesFindSong(query, country=country)
         if len(songs) == 0:
-            countries = try_countries[:]
-            print("Trying stores in other countries...", end=" ")
-            while len(songs) == 0 and len(countries):
-                cc = countries.pop()
-                print("[%s]" % cc, end=" ")
-                songs = iTunesFindSong(query, country=country)
-            print("")
+            # Skip stores that are already known to have nothing for this query
+            empty = knownEmptyCountries(query, "song", try_countries)
+            countries = [cc for cc in try_countries if cc != country and cc not in empty]
+            print("Trying stores in other countries... %s" %
+                  " ".join("[%s]" % cc for cc in countries))
+            songs = iTunesFindSong(query, country=countries, firstMatch=True)
             if len(songs) > 0:
+                cc = songs[0]['country']
                 print(colorize("Found %d results in [%s] store" % (
                     len(songs), cc), color=Color.yellowBG, enabled=args.color))
                 country = cc
@@ -142,7 +150,10 @@ def main(args):
 
     artwork = False
     if args.write:
-        artwork = urllib.request.urlopen(selectedSong['image']).read()
+        artwork = fetchArtwork(selectedSong['image'])
+        if artwork:
+            # Scaled down and recompressed once per album, cached on disk
+            artwork = normalizeArtwork(artwork)
 
     # Set metadata
     if args.write:
@@ -158,12 +169,14 @@ def main(args):
         "date": selectedSong["date"],
         "genre": selectedSong["genre"]
     }
-    metadata = setStuff(
-        filename=mp3,
-        artwork=artwork,
-        write=args.write,
-        clean=args.clean,
-        **trackdata)
+    session.set(artwork=artwork, clean=args.clean, **trackdata)
+    if args.write:
+        print(" - Done." if session.commit() else " - Unchanged.")
+    else:
+        # Preview of what would be written
+        for change in session.diff():
+            print("     %s" % str(change)[:100])
+    metadata = session.audio
 
     # Report
     print("")
@@ -210,6 +223,23 @@ if __name__ == "__main__":
         const=True,
         default=False,
         help='Sleep 5 seconds at the end of the script to keep the console window open on Windows')
+    parser.add_argument(
+        '--cache',
+        dest='cache',
+        default=None,
+        help='Cache iTunes API responses in this sqlite file')
+    parser.add_argument(
+        '--artwork-size',
+        dest='artworkSize',
+        type=int,
+        default=1000,
+        help='Maximum width and height of the embedded artwork, 0 embeds the original')
+    parser.add_argument(
+        '--artwork-kb',
+        dest='artworkBytes',
+        type=int,
+        default=200,
+        help='Maximum size of the embedded artwork in KiB')
     parser.add_argument(
         '--no-color',
         dest='color',
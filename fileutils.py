@@ -1,12 +1,35 @@
+import os
+import io
 import string
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, TPE1, TPE2, TPOS, TRCK, APIC, TDRC, TIT2, TCON, TALB, TPUB, TCOP, TPOS, TXXX
-from mutagen.mp4 import MP4, MP4Cover
+import hashlib
+import tempfile
+import collections
+import concurrent.futures
+from mutagen.mp3 import MP3, MPEGInfo
+from mutagen.id3 import ID3, ID3NoHeaderError, TPE1, TPE2, TPOS, TRCK, APIC, TDRC, TIT2, TCON, TALB, TPUB, TCOP, TPOS, TXXX
+from mutagen.mp4 import MP4, MP4Cover, MP4Tags, MP4Info, Atoms
 
 __all__ = [
     "asciiString",
     "getStuff",
+    "scanStuff",
+    "scanTags",
     "setStuff",
+    "PaddingPolicy",
+    "setPaddingPolicy",
+    "TagSession",
+    "TagChange",
+    "diffStuff",
+    "TrackMetadata",
+    "Artwork",
+    "hasArtwork",
+    "artworkDigest",
+    "ArtworkPolicy",
+    "setArtworkPolicy",
+    "setArtworkCache",
+    "normalizeArtwork",
+    "setStuffMany",
+    "commitMany",
     "getAlbumInfoString",
     "getSongInfoString",
     "getTrackInfoString",
@@ -20,12 +43,189 @@ def asciiString(s):
     return "".join(filter(lambda x: x in string.printable, s))
 
 
-def valueOrEmpty(metadata, key, key2=False):
-    if key in metadata and metadata[key]:
-        return str(metadata[key])
-    if key2 and key2 in metadata and metadata[key2]:
-        return str(metadata[key2])
-    return ""
+# Where the fields of TrackMetadata are stored in each container format.
+# Text fields are a single string, pairs are stored as "3/12" in ID3 and as a tuple in MP4.
+_mp3Fields = {
+    "title": "TIT2",
+    "artist": "TPE1",
+    "albumArtist": "TPE2",
+    "album": "TALB",
+    "date": "TDRC",
+    "genre": "TCON",
+    "publisher": "TPUB",
+    "itunescatalogid": "TXXX:itunescatalogid",
+    "itunesartistid": "TXXX:itunesartistid",
+    "itunesalbumid": "TXXX:itunesalbumid",
+}
+_mp3Pairs = {
+    "track": ("TRCK", 0),
+    "totalTracks": ("TRCK", 1),
+    "disc": ("TPOS", 0),
+    "totalDiscs": ("TPOS", 1),
+}
+_mp4Fields = {
+    "title": "\xa9nam",
+    "artist": "\xa9ART",
+    "albumArtist": "aART",
+    "album": "\xa9alb",
+    "date": "\xa9day",
+    "genre": "\xa9gen",
+    "publisher": "cprt",
+    "itunescatalogid": "cnID",
+    "itunesartistid": "atID",
+    "itunesalbumid": "plID",
+}
+_mp4Pairs = {
+    "track": ("trkn", 0),
+    "totalTracks": ("trkn", 1),
+    "disc": ("disk", 0),
+    "totalDiscs": ("disk", 1),
+}
+_numberFields = ("itunescatalogid", "itunesartistid", "itunesalbumid")
+
+
+def _tagsOf(audio):
+    # MP3/MP4 objects have the tags in .tags, ID3/MP4Tags objects are the tags
+    if isinstance(audio, (MP3, MP4)):
+        return audio.tags if audio.tags is not None else {}
+    return audio
+
+
+def _typeOf(audio):
+    return 'mp4' if isinstance(audio, (MP4, MP4Tags)) else 'mp3'
+
+
+def _toInt(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _readField(audio, type, name):
+    tags = _tagsOf(audio)
+    fields, pairs = (_mp3Fields, _mp3Pairs) if type == 'mp3' else (_mp4Fields, _mp4Pairs)
+
+    if name in pairs:
+        key, index = pairs[name]
+        if key not in tags:
+            return None
+        if type == 'mp3':
+            if not tags[key].text:
+                return None
+            parts = str(tags[key].text[0]).split("/")
+        else:
+            if not tags[key] or not len(tags[key][0]):
+                return None
+            parts = tags[key][0]
+        value = _toInt(parts[index]) if index < len(parts) else None
+        # MP4 stores a missing total as 0
+        return value if value or type == 'mp3' else None
+
+    key = fields[name]
+    if key not in tags:
+        return None
+    value = tags[key].text if type == 'mp3' else tags[key]
+    if not value:
+        return None
+    if name in _numberFields:
+        return _toInt(value[0])
+    return str(value[0])
+
+
+class TrackMetadata:
+    """The tags of a file that are used for searching and comparing, read directly
+    from the mutagen object with the mapping tables above. Missing values are None.
+    """
+    __slots__ = ("type", "title", "artist", "albumArtist", "album", "track", "totalTracks",
+                 "disc", "totalDiscs", "date", "genre", "publisher",
+                 "itunescatalogid", "itunesartistid", "itunesalbumid")
+
+    def __init__(self, type='mp3', **fields):
+        self.type = type
+        for name in self.__slots__[1:]:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError("Unknown fields: %s" % ", ".join(fields))
+
+    @classmethod
+    def fromAudio(cls, audio, type=None):
+        """From a MP3, MP4, ID3 or MP4Tags object"""
+        type = type or _typeOf(audio)
+        return cls(type, **{name: _readField(audio, type, name) for name in cls.__slots__[1:]})
+
+    @classmethod
+    def fromStuff(cls, stuff):
+        """From a dict in the format of getStuff(), for dicts that do not carry the metadata"""
+        type = stuff.get('type', 'mp3')
+        fields, pairs = (_mp3Fields, _mp3Pairs) if type == 'mp3' else (_mp4Fields, _mp4Pairs)
+        values = {}
+        for name, key in fields.items():
+            value = stuff.get(key)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            if value is None or value == "":
+                continue
+            values[name] = _toInt(value) if name in _numberFields else str(value)
+        for name, (key, index) in pairs.items():
+            value = stuff.get(key)
+            if isinstance(value, list):
+                value = value[0] if value else None
+            if value is None or value == "":
+                continue
+            if isinstance(value, int):
+                parts = (value, )
+            elif isinstance(value, tuple):
+                parts = value
+            else:
+                parts = str(value).split("/")
+            number = _toInt(parts[index]) if index < len(parts) else None
+            # MP4 stores a missing total as 0
+            values[name] = number if number or type == 'mp3' else None
+        return cls(type, **values)
+
+    def asDict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, TrackMetadata) and self.asDict() == other.asDict()
+
+    def __repr__(self):
+        return "TrackMetadata(%s)" % ", ".join("%s=%r" % (name, getattr(self, name))
+                                             for name in self.__slots__ if getattr(self, name) is not None)
+
+
+class Stuff(dict):
+    """The dict returned by getStuff(), with the parsed tags in .metadata"""
+    __slots__ = ("_metadata", )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = TrackMetadata.fromStuff(self)
+        return self._metadata
+
+    def __reduce__(self):
+        return _restoreStuff, (dict(self), self.metadata)
+
+
+def _restoreStuff(items, metadata):
+    d = Stuff(items)
+    d._metadata = metadata
+    return d
+
+
+def _metadataOf(metadata):
+    # The helpers accept TrackMetadata, a TagSession or a dict from getStuff()
+    if isinstance(metadata, TrackMetadata):
+        return metadata
+    if isinstance(metadata, (Stuff, TagSession)):
+        return metadata.metadata
+    return TrackMetadata.fromStuff(metadata)
 
 
 def getStuff(filename, loud=True):
@@ -36,46 +236,209 @@ def getStuff(filename, loud=True):
 
 
 def getStuff_mp3(filename, loud=True):
-    audio = MP3(filename)
-    d = {'type': 'mp3'}
+    return _stuff_mp3(MP3(filename), loud)
+
+
+def _shorten(text):
+    return text[:50] + ("... ... ..." if len(text) > 49 else "")
+
+
+def _stuff_mp3(audio, loud=True):
+    d = Stuff(type='mp3')
+    d._metadata = TrackMetadata.fromAudio(audio, 'mp3')
 
     for attr in audio:
-        d[attr] = str(audio[attr])[:50] + \
-            ("... ... ..." if len(str(audio[attr])) > 49 else "")
+        text = str(audio[attr])
+        d[attr] = _shorten(text)
         if loud:
             try:
-                print("$" + attr + "$\t",
-                      str(audio[attr])[:50],
-                      "... ... ..." if len(str(audio[attr])) > 49 else "")
+                print("$" + attr + "$\t", d[attr])
             except BaseException:
                 pass
     return d
 
 
 def getStuff_m4a(filename, loud=True):
-    audio = MP4(filename)
-    d = {'type': 'mp4'}
+    return _stuff_m4a(MP4(filename), loud)
+
+
+def _stuff_m4a(audio, loud=True):
+    d = Stuff(type='mp4')
+    d._metadata = TrackMetadata.fromAudio(audio, 'mp4')
     for attr in audio:
         value = audio[attr]
         if isinstance(value, list) and len(value) == 1:
             value = value[0]
 
         if isinstance(value, str):
-            d[attr] = str(value)[:50] + \
-                ("... ... ..." if len(str(value)) > 49 else "")
+            d[attr] = _shorten(value)
         else:
             d[attr] = value
 
         if loud:
             try:
-                print("$" + attr + "$\t",
-                      str(value)[:50],
-                      "... ... ..." if len(str(value)) > 49 else "")
+                print("$" + attr + "$\t", _shorten(str(value)))
             except BaseException:
                 pass
     return d
 
 
+# First read of scanStuff_mp3(), the ID3 tag is usually completely contained
+scanHeadBytes = 64 * 1024
+
+
+def scanStuff(filename, loud=False, streamInfo=False):
+    """Like getStuff() but only reads the tags, not the audio stream.
+
+    With streamInfo=True the stream info is parsed as well and added as
+    'length' (seconds) and 'bitrate' (bits per second).
+    """
+    if filename.lower().endswith('.mp3'):
+        return scanStuff_mp3(filename, loud, streamInfo)
+    else:
+        return scanStuff_m4a(filename, loud, streamInfo)
+
+
+def _id3TagSize(header):
+    # Size of the ID3v2 tag including header and footer, 0 if there is none
+    if len(header) < 10 or header[0:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7f)
+    return 10 + size + (10 if header[5] & 0x10 else 0)
+
+
+def scanTags(filename):
+    """Only the tags of a file as ID3 or MP4Tags object (an empty dict if there are none)"""
+    with open(filename, 'rb') as f:
+        if filename.lower().endswith('.mp3'):
+            return _scanTags_mp3(f)[0]
+        return _scanTags_m4a(f)[0]
+
+
+# ID3v1 tag plus the bytes mutagen reads before it to detect an APEv2 tag
+id3v1TailBytes = 128 + 5
+
+
+def _scanTags_mp3(f):
+    head = f.read(scanHeadBytes)
+    size = _id3TagSize(head)
+    if size > len(head):
+        # Large tag, e.g. with artwork, read the rest of it in one go
+        head += f.read(size - len(head))
+
+    if size:
+        # ID3v1 frames that are missing in the ID3v2 tag are merged like getStuff()
+        # does, mutagen finds them in the last bytes of the file
+        f.seek(0, 2)
+        end = f.tell()
+        f.seek(max(size, end - id3v1TailBytes))
+        tags = ID3(io.BytesIO(head[0:size] + f.read()))
+    else:
+        # No ID3v2 tag, look for ID3v1 at the end of the file
+        try:
+            tags = ID3(f)
+        except ID3NoHeaderError:
+            tags = {}
+    return tags, size
+
+
+def _scanTags_m4a(f):
+    # Only the atom headers are read, the audio data in mdat is skipped
+    atoms = Atoms(f)
+    if b"moov.udta.meta.ilst" in atoms:
+        tags = MP4Tags(atoms, f)
+    else:
+        tags = {}
+    return tags, atoms
+
+
+def scanStuff_mp3(filename, loud=False, streamInfo=False):
+    with open(filename, 'rb') as f:
+        tags, size = _scanTags_mp3(f)
+        d = _stuff_mp3(tags, loud)
+        if streamInfo:
+            f.seek(0)
+            info = MPEGInfo(f, size)
+            d["length"] = info.length
+            d["bitrate"] = info.bitrate
+    return d
+
+
+def scanStuff_m4a(filename, loud=False, streamInfo=False):
+    with open(filename, 'rb') as f:
+        tags, atoms = _scanTags_m4a(f)
+        d = _stuff_m4a(tags, loud)
+        if streamInfo:
+            info = MP4Info()
+            info.load(atoms, f)
+            d["length"] = info.length
+            d["bitrate"] = info.bitrate
+    return d
+
+
+class PaddingPolicy:
+    """Decides how much padding the tags keep after saving, used as save(padding=...).
+
+    A tag that still fits into the existing padding is written in place. If it
+    does not fit, the file has to be rewritten anyway and reserve bytes plus
+    ratio times the missing bytes are added as padding, so that later edits
+    fit. Padding is never larger than maximum, larger padding is reduced to
+    reserve on the next save (None never reduces it).
+    """
+
+    def __init__(self, reserve=16 * 1024, ratio=0.1, maximum=64 * 1024):
+        self.reserve = reserve
+        self.ratio = ratio
+        self.maximum = maximum
+
+    def __call__(self, info):
+        if info.padding >= 0:
+            if self.maximum is None or info.padding <= self.maximum:
+                return info.padding
+            return self.reserve
+        padding = self.reserve + int(self.ratio * -info.padding)
+        return padding if self.maximum is None else min(padding, self.maximum)
+
+    def __repr__(self):
+        return "PaddingPolicy(reserve=%d, ratio=%r, maximum=%r)" % (self.reserve, self.ratio, self.maximum)
+
+
+_paddingPolicy = PaddingPolicy()
+
+
+def setPaddingPolicy(policy):
+    """Set the PaddingPolicy (or any mutagen padding function) used for saving, None for mutagen's default"""
+    global _paddingPolicy
+    _paddingPolicy = policy
+
+
+def _save(audio):
+    # Save with the padding policy and report whether the file was written in place:
+    # {"inPlace": bool, "padding": bytes, "movedBytes": audio data moved, "sizeDelta": bytes}
+    calls = []
+
+    def padding(info):
+        if _paddingPolicy is None:
+            new = info.get_default_padding()
+        else:
+            new = _paddingPolicy(info)
+        calls.append((info, new))
+        return new
+
+    size = os.path.getsize(audio.filename)
+    audio.save(padding=padding)
+    report = {"inPlace": None, "padding": None, "movedBytes": None,
+              "sizeDelta": os.path.getsize(audio.filename) - size}
+    if calls:
+        info, new = calls[-1]
+        report["inPlace"] = info.padding >= 0 and new == info.padding
+        report["padding"] = new
+        report["movedBytes"] = 0 if report["inPlace"] else info.size
+    return report
+
+
 def setStuff(
         filename,
         title=None,
@@ -132,6 +495,43 @@ def setStuff_mp3(
         print(" - Failed.")
         return False
 
+    before = _tagSnapshot(audio)
+    _applyStuff_mp3(audio, title, artist, albumArtist, album, track,
+                    totalTracks, date, genre, artwork, publisher,
+                    itunescatalogid, itunesartistid, itunesalbumid,
+                    disc, totalDiscs, clean)
+
+    # The change set is returned as audio.changes
+    audio.changes = _diffSnapshots(before, _tagSnapshot(audio))
+    if write and audio.changes:
+        _save(audio)
+        print(" - Done.")
+    elif write:
+        # Every frame already had this value
+        print(" - Unchanged.")
+    else:
+        print("")
+    return audio
+
+
+def _applyStuff_mp3(
+        audio,
+        title=None,
+        artist=None,
+        albumArtist=None,
+        album=None,
+        track=None,
+        totalTracks=None,
+        date=None,
+        genre=None,
+        artwork=False,
+        publisher=None,
+        itunescatalogid=None,
+        itunesartistid=None,
+        itunesalbumid=None,
+        disc=None,
+        totalDiscs=None,
+        clean=False):
     if clean:
         # Delete all tags
         audio.clear()
@@ -185,12 +585,14 @@ def setStuff_mp3(
     if genre is not None:
         audio["TCON"] = TCON(encoding=3, text=genre)
 
-    if artwork:
+    if artwork and not hasArtwork(audio, artwork):
         # Add artwork
+        if audio.tags is None:
+            audio.add_tags()
         audio.tags.add(
             APIC(
                 encoding=3,  # 3 is for utf-8
-                mime='image/jpeg',  # image/jpeg or image/png
+                mime=artwork.mime if isinstance(artwork, Artwork) else _sniffMime(artwork),
                 type=3,  # 3 is for the cover image
                 desc=u'',
                 data=artwork
@@ -210,13 +612,6 @@ def setStuff_mp3(
     if itunesalbumid is not None:
         audio["TXXX:itunesalbumid"] = TXXX(encoding=3, desc='itunesalbumid', text=[str(int(itunesalbumid))])
 
-    if write:
-        audio.save()
-        print(" - Done.")
-    else:
-        print("")
-    return audio
-
 
 def setStuff_m4a(
         filename,
@@ -246,6 +641,43 @@ def setStuff_m4a(
         print(" - Failed.")
         return False
 
+    before = _tagSnapshot(audio)
+    _applyStuff_m4a(audio, title, artist, albumArtist, album, track,
+                    totalTracks, date, genre, artwork, publisher,
+                    itunescatalogid, itunesartistid, itunesalbumid,
+                    disc, totalDiscs, clean)
+
+    # The change set is returned as audio.changes
+    audio.changes = _diffSnapshots(before, _tagSnapshot(audio))
+    if write and audio.changes:
+        _save(audio)
+        print(" - Done.")
+    elif write:
+        # Every frame already had this value
+        print(" - Unchanged.")
+    else:
+        print("")
+    return audio
+
+
+def _applyStuff_m4a(
+        audio,
+        title=None,
+        artist=None,
+        albumArtist=None,
+        album=None,
+        track=None,
+        totalTracks=None,
+        date=None,
+        genre=None,
+        artwork=False,
+        publisher=None,
+        itunescatalogid=None,
+        itunesartistid=None,
+        itunesalbumid=None,
+        disc=None,
+        totalDiscs=None,
+        clean=False):
     if clean:
         # Delete all tags
         audio.clear()
@@ -286,12 +718,12 @@ def setStuff_m4a(
     if genre is not None:
         audio["\xa9gen"] = [str(genre)]
 
-    if artwork:
+    if artwork and not hasArtwork(audio, artwork):
         # Add artwork
         audio["covr"] = [
             MP4Cover(
                 data=artwork,
-                imageformat=MP4Cover.FORMAT_JPEG)]
+                imageformat=MP4Cover.FORMAT_PNG if _sniffMime(artwork) == 'image/png' else MP4Cover.FORMAT_JPEG)]
 
     if publisher is not None:
         audio["cprt"] = [str(publisher)]
@@ -305,314 +737,641 @@ def setStuff_m4a(
     if itunesalbumid is not None:
         audio["plID"] = [int(itunesalbumid)]
 
-    if write:
-        audio.save()
-        print(" - Done.")
-    else:
-        print("")
-    return audio
 
+class Artwork(bytes):
+    """Image data that remembers its hash, create it once for a batch of files"""
 
-def getAlbumInfoString(metadata, mp3s):
-    if metadata['type'] == 'mp3':
-        return getAlbumInfoString_mp3(metadata, mp3s)
+    def __new__(cls, data, mime=None):
+        self = super().__new__(cls, data)
+        self.mime = mime or _sniffMime(data)
+        return self
+
+    @property
+    def digest(self):
+        if "_digest" not in self.__dict__:
+            self._digest = hashlib.sha1(self).hexdigest()
+        return self._digest
+
+
+def _sniffMime(data):
+    return 'image/png' if data[0:8] == b"\x89PNG\r\n\x1a\n" else 'image/jpeg'
+
+
+class ArtworkPolicy:
+    """Limits for the embedded artwork, see normalizeArtwork()
+
+    maxSize is the maximum width and height in pixels, maxBytes the byte budget.
+    JPEG quality is lowered step by step down to minQuality before the image
+    is scaled down further to fit into the budget.
+    """
+
+    def __init__(self, maxSize=1000, maxBytes=200 * 1024, quality=90, minQuality=65):
+        self.maxSize = maxSize
+        self.maxBytes = maxBytes
+        self.quality = quality
+        self.minQuality = minQuality
+
+    def key(self):
+        return "%d-%d-%d-%d" % (self.maxSize, self.maxBytes, self.quality, self.minQuality)
+
+    def __repr__(self):
+        return "ArtworkPolicy(maxSize=%d, maxBytes=%d, quality=%d, minQuality=%d)" % (
+            self.maxSize, self.maxBytes, self.quality, self.minQuality)
+
+
+_artworkPolicy = ArtworkPolicy()
+
+
+def _userCacheDir():
+    # Per user, other users must not be able to plant images in the cache
+    if os.name == 'nt':
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
     else:
-        return getAlbumInfoString_m4a(metadata, mp3s)
-
-
-def getAlbumInfoString_mp3(metadata, mp3s):
-    guess = ""
-    albuminfo = ""
-    if "TPE2" in metadata and metadata["TPE2"]:
-        guess = metadata["TPE2"]
-        albuminfo = metadata["TPE2"]
-    elif "TPE1" in metadata and metadata["TPE1"]:
-        artist = str(metadata["TPE1"])
-        if artist.endswith(' - Topic'):
-            artist = artist[0:-len(' - Topic')]
-        guess = artist
-        albuminfo = artist
-
-    if "TALB" in metadata and metadata["TALB"]:
-        guess += " - %s" % metadata["TALB"]
-        albuminfo += " - %s" % metadata["TALB"]
-
-    if "TRCK" in metadata and metadata["TRCK"] and "/" in metadata["TRCK"]:
-        trck = metadata["TRCK"].split("/")[1]
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "py_itunesart", "artwork")
+
+
+_artworkCacheDir = _userCacheDir()
+# The least recently used images are removed when the cache gets larger
+artworkCacheBytes = 64 * 1024 * 1024
+
+
+def setArtworkPolicy(policy):
+    """Set the ArtworkPolicy, None embeds the artwork unchanged"""
+    global _artworkPolicy
+    _artworkPolicy = policy
+
+
+def setArtworkCache(directory):
+    """Directory for normalized artwork, None disables the cache"""
+    global _artworkCacheDir
+    _artworkCacheDir = directory
+
+
+def normalizeArtwork(data, policy=None):
+    """Scale down and recompress artwork with Pillow to fit the ArtworkPolicy.
+
+    Metadata (EXIF, ICC profile, comments) is removed. Images with transparency
+    or few colors become PNG if that is smaller, everything else JPEG. Images
+    that already fit and have no metadata are returned unchanged. The result
+    is cached by hash of the source and policy in a per-user cache directory,
+    so an album cover is only processed once. Returns an Artwork; without Pillow the data is
+    returned unchanged.
+    """
+    policy = policy or _artworkPolicy
+    source = data if isinstance(data, Artwork) else Artwork(data)
+    if policy is None:
+        return source
+
+    cacheFile = None
+    if _artworkCacheDir:
+        cacheFile = os.path.join(_artworkCacheDir, "%s-%s" % (source.digest, policy.key()))
+        for ext, mime in (('.jpg', 'image/jpeg'), ('.png', 'image/png')):
+            if os.path.exists(cacheFile + ext):
+                try:
+                    with open(cacheFile + ext, 'rb') as f:
+                        data = f.read()
+                    os.utime(cacheFile + ext)
+                    return Artwork(data, mime)
+                except OSError:
+                    pass
+
+    try:
+        import PIL.Image
+    except ImportError:
+        return source
+
+    try:
+        result = _normalizeImage(PIL.Image, source, policy)
+    except (OSError, ValueError, PIL.Image.DecompressionBombError):
+        # Not an image Pillow can read, embed it as it is
+        return source
+
+    if cacheFile:
+        _storeArtwork(cacheFile + ('.png' if result.mime == 'image/png' else '.jpg'), result)
+    return result
+
+
+def _storeArtwork(filename, data):
+    directory = os.path.dirname(filename)
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Unique temporary name, other processes may store the same image at the same time
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
         try:
-            trck = int(trck)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, filename)
         except BaseException:
-            albuminfo += " (%d files)" % len(mp3s)
-        if trck == len(mp3s):
-            albuminfo += " (%d tracks)" % len(mp3s)
+            os.remove(tmp)
+            raise
+        _trimArtworkCache(directory)
+    except OSError:
+        pass
+
+
+def _trimArtworkCache(directory):
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= artworkCacheBytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def _normalizeImage(Image, source, policy):
+    img = Image.open(io.BytesIO(source))
+    hasMetadata = any(key in img.info for key in ("exif", "icc_profile", "comment", "xmp"))
+    if (img.format in ("JPEG", "PNG") and not hasMetadata and len(source) <= policy.maxBytes
+            and max(img.size) <= policy.maxSize):
+        return source
+
+    transparent = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    img = _toSrgb(img, "RGBA" if transparent else "RGB")
+    if max(img.size) > policy.maxSize:
+        img.thumbnail((policy.maxSize, policy.maxSize), Image.LANCZOS)
+    # Otherwise Pillow writes EXIF, ICC profile etc. from img.info into the PNG
+    img.info = {}
+
+    while True:
+        candidates = []
+        if transparent or img.getcolors(256) is not None:
+            out = io.BytesIO()
+            img.save(out, "PNG", optimize=True)
+            candidates.append(Artwork(out.getvalue(), 'image/png'))
+        if not transparent:
+            quality = policy.quality
+            while True:
+                out = io.BytesIO()
+                img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+                if out.tell() <= policy.maxBytes or quality <= policy.minQuality:
+                    break
+                quality -= 5
+            candidates.append(Artwork(out.getvalue(), 'image/jpeg'))
+
+        best = min(candidates, key=len)
+        if len(best) <= policy.maxBytes or max(img.size) <= 100:
+            return best
+        # Still too large, scale down
+        img = img.resize((max(1, int(img.size[0] * 0.85)), max(1, int(img.size[1] * 0.85))), Image.LANCZOS)
+        img.info = {}
+
+
+def _toSrgb(img, mode):
+    # Convert the pixels to sRGB if there is a color profile, because the profile is not kept
+    profile = img.info.get("icc_profile")
+    if profile:
+        if img.mode not in ("RGB", "RGBA", "CMYK", "L"):
+            img = img.convert(mode)
+        try:
+            from PIL import ImageCms
+            source = ImageCms.ImageCmsProfile(io.BytesIO(profile))
+            return ImageCms.profileToProfile(img, source, ImageCms.createProfile("sRGB"), outputMode=mode)
+        except Exception:
+            # No littlecms or a broken profile, keep the pixels as they are
+            pass
+    return img.convert(mode)
+
+
+def _embeddedArtwork(audio):
+    tags = _tagsOf(audio)
+    if _typeOf(audio) == 'mp4':
+        return [bytes(cover) for cover in tags.get("covr", [])]
+    if not tags:
+        return []
+    return [apic.data for apic in tags.getall("APIC")]
+
+
+def artworkDigest(audio):
+    """Hash of the first embedded picture of a MP3, MP4, ID3 or MP4Tags object, None if there is none"""
+    pictures = _embeddedArtwork(audio)
+    return hashlib.sha1(pictures[0]).hexdigest() if pictures else None
+
+
+def hasArtwork(audio, artwork):
+    """True if the image is already embedded in the MP3/MP4 object"""
+    digest = None
+    for data in _embeddedArtwork(audio):
+        # Only hash the embedded pictures that have the same size
+        if len(data) != len(artwork):
+            continue
+        if digest is None:
+            digest = artwork.digest if isinstance(artwork, Artwork) else hashlib.sha1(artwork).hexdigest()
+        if hashlib.sha1(data).hexdigest() == digest:
+            return True
+    return False
+
+
+def _tagSignature(value):
+    # Compare embedded pictures by a hash of their data instead of the full bytes
+    if isinstance(value, list):
+        return tuple(_tagSignature(v) for v in value)
+    if isinstance(value, MP4Cover):
+        return ("MP4Cover", value.imageformat, hashlib.sha1(value).hexdigest())
+    if isinstance(getattr(value, "data", None), bytes):
+        return (type(value).__name__, getattr(value, "mime", None), getattr(value, "type", None),
+                getattr(value, "desc", None), hashlib.sha1(value.data).hexdigest())
+    return repr(value)
+
+
+def _tagDisplay(value):
+    # Short readable form of a tag value for change sets
+    if isinstance(value, list):
+        return ", ".join(_tagDisplay(v) for v in value)
+    if isinstance(value, MP4Cover):
+        return "<image %d bytes>" % len(value)
+    if isinstance(getattr(value, "data", None), bytes):
+        return "<%s %d bytes>" % (getattr(value, "mime", "data"), len(value.data))
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+
+def _tagSnapshot(audio):
+    # {key: (signature for comparing, value for displaying)}
+    if audio.tags is None:
+        return {}
+    return {key: (_tagSignature(audio.tags[key]), _tagDisplay(audio.tags[key])) for key in audio.tags.keys()}
+
+
+class TagChange:
+    """A tag frame that was added, modified or removed, old/new are None if the frame did not exist"""
+    __slots__ = ("key", "old", "new")
+
+    def __init__(self, key, old, new):
+        self.key = key
+        self.old = old
+        self.new = new
+
+    @property
+    def kind(self):
+        if self.old is None:
+            return "added"
+        if self.new is None:
+            return "removed"
+        return "modified"
+
+    def __str__(self):
+        if self.kind == "added":
+            return "+ %s: %s" % (self.key, self.new)
+        if self.kind == "removed":
+            return "- %s: %s" % (self.key, self.old)
+        return "~ %s: %s -> %s" % (self.key, self.old, self.new)
+
+    def __repr__(self):
+        return "TagChange(%r, %r, %r)" % (self.key, self.old, self.new)
+
+
+def _diffSnapshots(before, after):
+    changes = []
+    for key in sorted(set(before) | set(after)):
+        old = before.get(key)
+        new = after.get(key)
+        if old is None or new is None or old[0] != new[0]:
+            changes.append(TagChange(key, old and old[1], new and new[1]))
+    return changes
+
+
+def diffStuff(filename, **kwargs):
+    """Preview of setStuff(): the list of TagChange, the file is not written"""
+    return TagSession(filename).set(**kwargs).diff()
+
+
+class TagSession:
+    """Parses the tags of a file once for reading, comparing and writing.
+
+    with TagSession(filename) as session:
+        print(session.title, session.track)
+        session.set(title="New title", track=3, totalTracks=12)
+        session.commit()
+
+    set() takes the same keywords as setStuff(). The file is only written by
+    commit() and only if a tag was changed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        if filename.lower().endswith('.mp3'):
+            self.type = 'mp3'
+            self.audio = MP3(filename)
         else:
-            albuminfo += " (%d tracks, %d files)" % (trck, len(mp3s))
-    else:
-        albuminfo += " (%d files)" % len(mp3s)
-    return albuminfo, guess
+            self.type = 'mp4'
+            self.audio = MP4(filename)
+        self._snapshot = _tagSnapshot(self.audio)
+        self.saveReport = None
+        self.committedChanges = []
 
+    def __enter__(self):
+        return self
 
-def getAlbumInfoString_m4a(metadata, mp3s):
-    guess = ""
-    albuminfo = ""
-    if "aART" in metadata and metadata["aART"]:
-        guess = metadata["aART"]
-        albuminfo = metadata["aART"]
-    elif "\xa9ART" in metadata and metadata["\xa9ART"]:
-        guess = metadata["\xa9ART"]
-        albuminfo = metadata["\xa9ART"]
-
-    if "\xa9alb" in metadata and metadata["\xa9alb"]:
-        guess += " - %s" % metadata["\xa9alb"]
-        albuminfo += " - %s" % metadata["\xa9alb"]
-
-    if "trkn" in metadata and isinstance(
-            metadata["trkn"], tuple) and len(
-            metadata["trkn"]) > 1:
-        trck = metadata["trkn"]
-        try:
-            trck = trck[1]
-        except BaseException:
-            albuminfo += " (%d files)" % len(mp3s)
-        if trck == len(mp3s):
-            albuminfo += " (%d tracks)" % len(mp3s)
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def stuff(self, loud=False):
+        """The same dict as getStuff()"""
+        if self.type == 'mp3':
+            return _stuff_mp3(self.audio, loud)
+        return _stuff_m4a(self.audio, loud)
+
+    def set(self, **kwargs):
+        if self.type == 'mp3':
+            _applyStuff_mp3(self.audio, **kwargs)
         else:
-            albuminfo += " (%d tracks, %d files)" % (trck, len(mp3s))
-    else:
-        albuminfo += " (%d files)" % len(mp3s)
-    return albuminfo, guess
+            _applyStuff_m4a(self.audio, **kwargs)
+        return self
 
+    def diff(self):
+        """TagChange for every frame that was added, modified or removed since the last commit"""
+        return self._diff()[0]
 
-def getSongInfoString(metadata):
-    if metadata['type'] == 'mp3':
-        return getSongInfoString_mp3(metadata)
-    else:
-        return getSongInfoString_m4a(metadata)
-
-
-def getSongInfoString_mp3(metadata):
-    guess = ""
-    albuminfo = ""
-    if "TPE1" in metadata and metadata["TPE1"]:
-        artist = str(metadata["TPE1"])
-        if artist.endswith(' - Topic'):
-            artist = artist[0:-len(' - Topic')]
-        guess = artist
-        albuminfo = artist
-    elif "TPE2" in metadata and metadata["TPE2"]:
-        guess = metadata["TPE2"]
-        albuminfo = metadata["TPE2"]
-
-    if "TIT2" in metadata and metadata["TIT2"]:
-        guess += " - %s" % metadata["TIT2"]
-        albuminfo += " - %s" % metadata["TIT2"]
-    elif "TALB" in metadata and metadata["TALB"]:
-        guess += " - %s" % metadata["TALB"]
-        albuminfo += " - %s" % metadata["TALB"]
-
-    if "TRCK" in metadata and metadata["TRCK"]:
-        albuminfo += " (#%s)" % str(metadata["TRCK"])
+    def _diff(self):
+        current = _tagSnapshot(self.audio)
+        return _diffSnapshots(self._snapshot, current), current
 
-    return albuminfo, guess
+    def changes(self):
+        """Keys of the tags that were added, modified or removed since the last commit"""
+        return [change.key for change in self.diff()]
 
+    @property
+    def changed(self):
+        return bool(self.changes())
 
-def getSongInfoString_m4a(metadata):
-    guess = ""
-    albuminfo = ""
-    if "\xa9ART" in metadata and metadata["\xa9ART"]:
-        guess = metadata["\xa9ART"]
-        albuminfo = metadata["\xa9ART"]
-    elif "aART" in metadata and metadata["aART"]:
-        guess = metadata["aART"]
-        albuminfo = metadata["aART"]
-
-    if "\xa9nam" in metadata and metadata["\xa9nam"]:
-        guess += " - %s" % metadata["\xa9nam"]
-        albuminfo += " - %s" % metadata["\xa9nam"]
-    elif "\xa9alb" in metadata and metadata["\xa9alb"]:
-        guess += " - %s" % metadata["\xa9alb"]
-        albuminfo += " - %s" % metadata["\xa9alb"]
-
-    if "trkn" in metadata and metadata["trkn"]:
-        if isinstance(metadata["trkn"], tuple):
-            albuminfo += " (#%s)" % str(metadata["trkn"][0])
-        else:
-            albuminfo += " (#%s)" % str(metadata["trkn"])
+    def commit(self):
+        """Save the file if a tag was changed, returns True if the file was written.
 
-    return albuminfo, guess
+        The TagChange list of the commit is in committedChanges, details of
+        the save in saveReport, see _save()
+        """
+        self.committedChanges, current = self._diff()
+        if not self.committedChanges:
+            return False
+        self.saveReport = _save(self.audio)
+        # Saving does not change the tags, the snapshot of the diff is still valid
+        self._snapshot = current
+        return True
 
+    @property
+    def metadata(self):
+        """The tags as TrackMetadata"""
+        return TrackMetadata.fromAudio(self.audio)
 
-def getTrackInfoString(metadata):
-    if metadata['type'] == 'mp3':
-        return getTrackInfoString_mp3(metadata)
-    else:
-        return getTrackInfoString_m4a(metadata)
+    @property
+    def title(self):
+        return _readField(self.audio, self.type, "title")
 
+    @property
+    def artist(self):
+        return _readField(self.audio, self.type, "artist")
 
-def getTrackInfoString_mp3(metadata):
-    trackinfo = ""
-    if "TRCK" in metadata and metadata["TRCK"]:
-        if "/" in metadata["TRCK"]:
-            try:
-                trackinfo += "(%02d/%02d) " % tuple(int(x)
-                                                    for x in metadata["TRCK"].split("/"))
-            except ValueError:
-                trackinfo += "(%2s/%2s) " % tuple(metadata["TRCK"].split("/"))
-        else:
-            try:
-                trackinfo += "(%02d/ ?) " % (int(metadata["TRCK"]), )
-            except ValueError:
-                trackinfo += "(%2s/ ?) " % (metadata["TRCK"], )
-    else:
-        trackinfo += "( ?/? ) "
+    @property
+    def albumArtist(self):
+        return _readField(self.audio, self.type, "albumArtist")
 
-    if "TPE1" in metadata and metadata["TPE1"]:
-        trackinfo += metadata["TPE1"]
-    elif "TPE2" in metadata and metadata["TPE2"]:
-        trackinfo += metadata["TPE2"]
-    else:
-        trackinfo += "  "
+    @property
+    def album(self):
+        return _readField(self.audio, self.type, "album")
 
-    if "TIT2" in metadata and metadata["TIT2"]:
-        trackinfo += " - %s" % metadata["TIT2"]
+    @property
+    def track(self):
+        return _readField(self.audio, self.type, "track")
 
-    if trackinfo.strip() == '( ?/? )':
-        # empty data
-        trackinfo = ""
+    @property
+    def totalTracks(self):
+        return _readField(self.audio, self.type, "totalTracks")
 
-    return trackinfo
+    @property
+    def disc(self):
+        return _readField(self.audio, self.type, "disc")
 
+    @property
+    def totalDiscs(self):
+        return _readField(self.audio, self.type, "totalDiscs")
 
-def getTrackInfoString_m4a(metadata):
-    trackinfo = ""
-    if "trkn" in metadata and metadata["trkn"]:
-        if isinstance(metadata["trkn"], tuple):
-            try:
-                trackinfo += "(%02d/%02d) " % tuple(int(x)
-                                                    for x in metadata["trkn"][0:2])
-            except ValueError:
-                trackinfo += "(%2s/%2s) " % metadata["trkn"][0:2]
-        else:
-            try:
-                trackinfo += "(%02d/ ?) " % (int(metadata["trkn"]), )
-            except ValueError:
-                trackinfo += "(%2s/ ?) " % str(metadata["trkn"])
-    else:
-        trackinfo += "( ?/? ) "
+    @property
+    def date(self):
+        return _readField(self.audio, self.type, "date")
 
-    if "\xa9ART" in metadata and metadata["\xa9ART"]:
-        trackinfo += metadata["\xa9ART"]
-    elif "aART" in metadata and metadata["aART"]:
-        trackinfo += metadata["aART"]
-    else:
-        trackinfo += "  "
+    @property
+    def genre(self):
+        return _readField(self.audio, self.type, "genre")
 
-    if "\xa9nam" in metadata and metadata["\xa9nam"]:
-        trackinfo += " - %s" % metadata["\xa9nam"]
+    @property
+    def publisher(self):
+        return _readField(self.audio, self.type, "publisher")
 
-    if trackinfo.strip() == '( ?/? )':
-        # empty data
-        trackinfo = ""
+    @property
+    def artwork(self):
+        """Data of the embedded pictures"""
+        return _embeddedArtwork(self.audio)
 
-    return trackinfo
 
+# Default number of files that are written at the same time on one device
+writesPerDevice = 4
 
-def getBasicTrackData(metadata):
-    if metadata['type'] == 'mp3':
-        return getBasicTrackData_mp3(metadata)
+
+def _deviceOf(filename):
+    try:
+        return os.stat(os.path.dirname(os.path.abspath(filename))).st_dev
+    except OSError:
+        return None
+
+
+def _runMany(func, items, devices, workers, executor, perDevice, progress):
+    # Run func(item) in a pool with at most perDevice items per device at the same
+    # time. Progress is reported in the order of items, results are returned in order.
+    if executor == "process":
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    elif executor == "thread":
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
     else:
-        return getBasicTrackData_m4a(metadata)
+        raise ValueError("executor must be 'thread' or 'process'")
+    perDevice = max(1, perDevice or workers)
+
+    queues = collections.OrderedDict()
+    for index, device in enumerate(devices):
+        queues.setdefault(device, collections.deque()).append(index)
+    active = collections.Counter()
+    running = {}
+    results = [None] * len(items)
+    finished = set()
+    reported = 0
+
+    with pool:
+        while queues or running:
+            for device in list(queues):
+                queue = queues[device]
+                while queue and active[device] < perDevice and len(running) < workers:
+                    index = queue.popleft()
+                    running[pool.submit(func, items[index])] = index
+                    active[device] += 1
+                if not queue:
+                    del queues[device]
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                active[devices[index]] -= 1
+                try:
+                    results[index] = future.result()
+                except BaseException as e:
+                    results[index] = {"filename": _filenameOf(items[index]), "written": False,
+                                      "changes": [], "error": "%s: %s" % (type(e).__name__, e), "save": None}
+                finished.add(index)
+
+            while reported in finished:
+                if progress:
+                    progress(reported, len(items), results[reported])
+                reported += 1
+
+    return results
+
+
+def _filenameOf(item):
+    if isinstance(item, TagSession):
+        return item.filename
+    return item["filename"]
+
+
+def _setStuffJob(job):
+    job = dict(job)
+    filename = job.pop("filename")
+    write = job.pop("write", False)
+    result = {"filename": filename, "written": False, "changes": [], "error": None, "save": None}
+    try:
+        session = TagSession(filename)
+        session.set(**job)
+        if write:
+            result["written"] = session.commit()
+            result["changes"] = session.committedChanges
+            result["save"] = session.saveReport
+        else:
+            result["changes"] = session.diff()
+    except BaseException as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    return result
 
 
-def getBasicTrackData_mp3(metadata):
-    track = -1
-    totalTracks = -1
-    if "TRCK" in metadata and metadata["TRCK"]:
-        if "/" in metadata["TRCK"]:
-            try:
-                trackSplit = [int(x) for x in metadata["TRCK"].split("/")]
-                track = trackSplit[0]
-                totalTracks = trackSplit[1]
-            except (ValueError, IndexError) as e:
-                pass
-        else:
-            try:
-                track = int(metadata["TRCK"])
-            except ValueError:
-                pass
+def _commitJob(session):
+    result = {"filename": session.filename, "written": False, "changes": [], "error": None, "save": None}
+    try:
+        result["written"] = session.commit()
+        result["changes"] = session.committedChanges
+        result["save"] = session.saveReport
+    except BaseException as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    return result
 
-    return {
-        'album': valueOrEmpty(metadata, 'TALB'),
-        'artist': valueOrEmpty(metadata, 'TPE1', 'TPE2'),
-        'albumArtist': valueOrEmpty(metadata, 'TPE2', 'TPE1'),
-        'title': valueOrEmpty(metadata, 'TIT2'),
-        'track': track,
-        'totalTracks': totalTracks
-    }
 
+def setStuffMany(jobs, workers=8, executor="thread", perDevice=writesPerDevice, progress=None):
+    """Run setStuff() for many files in parallel.
 
-def getBasicTrackData_m4a(metadata):
-    track = -1
-    totalTracks = -1
-    if "trkn" in metadata and metadata["trkn"]:
-        if isinstance(metadata["trkn"], tuple):
-            try:
-                track = int(metadata["trkn"][0])
-                totalTracks = int(metadata["trkn"][1])
-            except (ValueError, IndexError) as e:
-                pass
-        else:
-            try:
-                track = int(metadata["trkn"])
-            except ValueError:
-                pass
+    jobs is a list of dicts with the keyword arguments of setStuff(), including
+    filename and write. Returns one dict per job, in the same order:
+    {"filename": ..., "written": bool, "changes": [TagChange], "error": None or str,
+     "save": None or the report of the save, e.g. {"inPlace": True, ...}}
 
-    return {
-        'album': valueOrEmpty(metadata, '\xa9alb'),
-        'artist': valueOrEmpty(metadata, '\xa9ART', 'aART'),
-        'albumArtist': valueOrEmpty(metadata, 'aART', '\xa9ART'),
-        'title': valueOrEmpty(metadata, '\xa9nam'),
-        'track': track,
-        'totalTracks': totalTracks
-    }
+    At most perDevice files on the same device are written at the same time,
+    use 1 for spinning disks. progress(index, total, result) is called in the
+    order of jobs.
+    """
+    jobs = list(jobs)
+    devices = [_deviceOf(job["filename"]) for job in jobs]
+    return _runMany(_setStuffJob, jobs, devices, workers, executor, perDevice, progress)
 
 
-def getBasicAlbumData(metadata):
-    if metadata['type'] == 'mp3':
-        return getBasicAlbumData_mp3(metadata)
+def commitMany(sessions, workers=8, perDevice=writesPerDevice, progress=None):
+    """Commit many TagSession objects in parallel threads, see setStuffMany()"""
+    sessions = list(sessions)
+    devices = [_deviceOf(session.filename) for session in sessions]
+    return _runMany(_commitJob, sessions, devices, workers, "thread", perDevice, progress)
+
+
+def _artistName(artist):
+    if artist and artist.endswith(' - Topic'):
+        return artist[0:-len(' - Topic')]
+    return artist
+
+
+def getAlbumInfoString(metadata, mp3s):
+    m = _metadataOf(metadata)
+    guess = m.albumArtist or _artistName(m.artist) or ""
+    albuminfo = guess
+
+    if m.album:
+        guess += " - %s" % m.album
+        albuminfo += " - %s" % m.album
+
+    if m.totalTracks is None:
+        albuminfo += " (%d files)" % len(mp3s)
+    elif m.totalTracks == len(mp3s):
+        albuminfo += " (%d tracks)" % len(mp3s)
     else:
-        return getBasicAlbumData_m4a(metadata)
+        albuminfo += " (%d tracks, %d files)" % (m.totalTracks, len(mp3s))
+    return albuminfo, guess
 
 
-def getBasicAlbumData_mp3(metadata):
-    trck = -1
-    if "TRCK" in metadata and metadata["TRCK"] and "/" in metadata["TRCK"]:
-        trck = metadata["TRCK"].split("/")[1]
-        try:
-            trck = int(trck)
-        except BaseException:
-            trck = len(mp3s)
+def getSongInfoString(metadata):
+    m = _metadataOf(metadata)
+    guess = _artistName(m.artist) or m.albumArtist or ""
+    albuminfo = guess
+
+    if m.title or m.album:
+        guess += " - %s" % (m.title or m.album)
+        albuminfo += " - %s" % (m.title or m.album)
+
+    if m.track is not None and m.totalTracks is not None:
+        albuminfo += " (#%d/%d)" % (m.track, m.totalTracks)
+    elif m.track is not None:
+        albuminfo += " (#%d)" % m.track
+
+    return albuminfo, guess
+
+
+def getTrackInfoString(metadata):
+    m = _metadataOf(metadata)
+    if m.track is not None and m.totalTracks is not None:
+        trackinfo = "(%02d/%02d) " % (m.track, m.totalTracks)
+    elif m.track is not None:
+        trackinfo = "(%02d/ ?) " % m.track
+    else:
+        trackinfo = "( ?/? ) "
 
+    trackinfo += m.artist or m.albumArtist or "  "
+
+    if m.title:
+        trackinfo += " - %s" % m.title
+
+    if trackinfo.strip() == '( ?/? )':
+        # empty data
+        trackinfo = ""
+
+    return trackinfo
+
+
+def getBasicTrackData(metadata):
+    m = _metadataOf(metadata)
     return {
-        'name': valueOrEmpty(metadata, 'TALB'),
-        'artist': valueOrEmpty(metadata, 'TPE2', 'TPE1'),
-        'totalTracks': trck,
+        'album': m.album or "",
+        'artist': m.artist or m.albumArtist or "",
+        'albumArtist': m.albumArtist or m.artist or "",
+        'title': m.title or "",
+        'track': m.track if m.track is not None else -1,
+        'totalTracks': m.totalTracks if m.totalTracks is not None else -1
     }
 
 
-def getBasicAlbumData_m4a(metadata):
-    trck = -1
-    if "trkn" in metadata and isinstance(
-            metadata["trkn"], tuple) and len(
-            metadata["trkn"]) > 1:
-        trck = metadata["trkn"]
-        try:
-            trck = int(trck[1])
-        except BaseException:
-            trck = len(mp3s)
-
+def getBasicAlbumData(metadata):
+    m = _metadataOf(metadata)
     return {
-        'name': valueOrEmpty(metadata, '\xa9alb'),
-        'artist': valueOrEmpty(metadata, 'aART', '\xa9ART'),
-        'totalTracks': trck
+        'name': m.album or "",
+        'artist': m.albumArtist or m.artist or "",
+        'totalTracks': m.totalTracks if m.totalTracks is not None else -1
     }
@@ -3,7 +3,6 @@ import sys
 import argparse
 import threading
 import subprocess
-import urllib.request
 import functools
 import io
 import os
@@ -17,8 +16,8 @@ from mutagen.mp3 import MP3
 from mutagen.mp4 import MP4, MP4Cover, AtomDataType
 from mutagen.id3 import APIC
 
-from itunesapi import iTunesFindAlbum, iTunesGetTracks
-from fileutils import setStuff
+from itunesapi import iTunesFindAlbum, fetchArtwork, Prefetcher
+from fileutils import TagSession, commitMany, normalizeArtwork, hasArtwork, ArtworkPolicy, setArtworkPolicy
 
 __version__ = "1.8"
 
@@ -38,8 +37,11 @@ class Gui(tk.Tk):
         self.title("iTunes Art Downloader")
 
         self.previewSize = 250
+        self.minPreviewSize = 90
         self.downloadSize = 800
+        self.prefetchCount = 4
         self.autocloseinseconds = 3
+        self.prefetcher = Prefetcher()
 
         self._resultWidgets = []
         self.current_images = []
@@ -135,6 +137,7 @@ class Gui(tk.Tk):
             self.removeCover(None)
 
     def close(self, event=None):
+        self.prefetcher.close()
         self.withdraw()
         sys.exit()
 
@@ -143,7 +146,7 @@ class Gui(tk.Tk):
         self.close()
 
     def _loadImage(self, widget, url):
-        raw_data = urllib.request.urlopen(url).read()
+        raw_data = fetchArtwork(url)
         im = PIL.Image.open(io.BytesIO(raw_data))
         im.thumbnail(size=(self.imageSize, self.imageSize))
         Gui._imageRefs[url] = PIL.ImageTk.PhotoImage(im)
@@ -165,13 +168,18 @@ class Gui(tk.Tk):
 
         self.imageSize = self.previewSize
 
-        searchResults = iTunesFindAlbum(
-            query, dimensions=(
-                self.imageSize, self.imageSize, 'bb'))
-
         max_width = max(min(1200, self.winfo_screenwidth()), self.winfo_width())
         max_height = max(min(800, self.winfo_screenheight()), self.winfo_height()) - 350
 
+        # Only request as many results as fit on the screen with the smallest preview size
+        maxResults = (int(max_width / (self.minPreviewSize + 10)) - 1) * \
+            int(max_height / (self.minPreviewSize + 10))
+
+        searchResults = iTunesFindAlbum(
+            query, dimensions=(
+                self.imageSize, self.imageSize, 'bb'),
+            limit=max(1, min(200, maxResults)))
+
         while True:
             itemsPerRow = int(max_width / (self.imageSize + 10)) - 1
             maxRows = int(max_height / (self.imageSize + 10))
@@ -181,6 +189,12 @@ class Gui(tk.Tk):
             else:
                 break
 
+        # Download full size covers and track lists of the first results
+        # while the user is choosing
+        self.prefetcher.cancel()
+        self.prefetcher.prefetch(searchResults, self.prefetchCount,
+                                 artworkSize=self.downloadSize)
+
         row = None
 
         if not searchResults:
@@ -259,17 +273,16 @@ class Gui(tk.Tk):
             self.entry.insert(0, "No files found")
             return
 
-        url = result['image'].replace(
-            "%dx%dbb.jpg" %
-            (self.imageSize, self.imageSize), "%dx%dbb.jpg" %
-            (self.downloadSize, self.downloadSize))
+        self.prefetcher.cancel(keep=result)
+
+        url = result.imageUrl(self.downloadSize, self.downloadSize)
         artwork = False
         if self.args.isAlbum:
             dirname = os.path.dirname(self.files[0])
             folderjpg = os.path.join(dirname, 'folder.jpg')
             newfolderjpg = os.path.join(dirname, '_newfolder.jpg')
 
-            urllib.request.urlretrieve(url, newfolderjpg)
+            self.prefetcher.saveArtwork(url, newfolderjpg)
             if os.path.exists(newfolderjpg):
                 try:
                     if os.path.exists(folderjpg):
@@ -288,28 +301,37 @@ class Gui(tk.Tk):
                 artwork = open(folderjpg, 'rb').read()
 
         if not artwork:
-            artwork = urllib.request.urlopen(url).read()
+            artwork = self.prefetcher.artwork(url)
 
         if not artwork:
             print("Could not download artwork")
             self.entry.delete(0, 'end')
             self.entry.insert(0, "Could not download artwork")
             return
+        # Scaled down to the artwork policy and hashed once, to find files that already have this cover
+        artwork = normalizeArtwork(artwork)
 
         iTunesGetTracksCache = {}
 
         i = 0
+        sessions = []
         for filename in self.files:
             trackNumber = None
-            if filename.lower().endswith('.mp3'):
-                try:
-                    audio = MP3(filename)
-                except BaseException:
-                    print("Could not open file: %s" % str(filename))
-                    continue
+            if not filename.lower().endswith(('.mp3', '.m4a')):
+                print("Wrong file extension. Expected .mp3 or .m4a")
+                continue
+            try:
+                # Parsed once, covers and album info are saved together
+                session = TagSession(filename)
+            except BaseException:
+                print("Could not open file: %s" % str(filename))
+                continue
+            audio = session.audio
+
+            if session.type == 'mp3':
                 apic = APIC(
                     encoding=3,  # 3 is for utf-8
-                    mime='image/jpeg',  # image/jpeg or image/png
+                    mime=artwork.mime,  # image/jpeg or image/png
                     type=3,  # 3 is for the cover image
                     desc=u'',
                     data=artwork
@@ -331,7 +353,7 @@ class Gui(tk.Tk):
                             if picindex not in self.current_images_remove:
                                 audio.tags.add(pic)
 
-                else:
+                elif not hasArtwork(audio, artwork):
                     audio.tags.add(apic)
 
                 if "TRCK" in audio and audio["TRCK"]:
@@ -340,21 +362,10 @@ class Gui(tk.Tk):
                         trackNumber = int(m[0])
                     except:
                         pass
-
-                try:
-                    audio.save()
-                except BaseException:
-                    print("Could not save file: %s" % str(filename))
-                    continue
-            elif filename.lower().endswith('.m4a'):
-                try:
-                    audio = MP4(filename)
-                except BaseException:
-                    print("Could not open file: %s" % str(filename))
-                    continue
+            else:
                 mp4cover = MP4Cover(
                     data=artwork,
-                    imageformat=MP4Cover.FORMAT_JPEG)
+                    imageformat=MP4Cover.FORMAT_PNG if artwork.mime == 'image/png' else MP4Cover.FORMAT_JPEG)
 
                 if self.check_remove_all.get():
                     audio["covr"] = [mp4cover]
@@ -371,7 +382,7 @@ class Gui(tk.Tk):
                             if picindex not in self.current_images_remove:
                                 audio["covr"].append(pic)
 
-                else:
+                elif not hasArtwork(audio, artwork):
                     if "covr" in audio:
                         audio["covr"].append(mp4cover)
                     else:
@@ -383,15 +394,6 @@ class Gui(tk.Tk):
                     except:
                         pass
 
-                try:
-                    audio.save()
-                except BaseException:
-                    print("Could not save file: %s" % str(filename))
-                    continue
-            else:
-                print("Wrong file extension. Expected .mp3 or .m4a")
-                continue
-
             # Set album infos
             if self.check_set_album_info.get():
                 # find catalogId in track info
@@ -403,7 +405,7 @@ class Gui(tk.Tk):
                     if result['collectionId'] in iTunesGetTracksCache:
                         trackresults = iTunesGetTracksCache[result['collectionId']]
                     else:
-                        trackresults = iTunesGetTracks(
+                        trackresults = self.prefetcher.tracks(
                             collectionId=result['collectionId'])
                         iTunesGetTracksCache[result['collectionId']
                                              ] = trackresults
@@ -433,15 +435,16 @@ class Gui(tk.Tk):
                     "disc": disc,
                     "totalDiscs": totalDiscs
                 }
-                r = setStuff(
-                    filename=filename,
-                    write=True,
-                    clean=False,
-                    **trackdata)
-                if not r:
-                    print("Failed to set album metadata info")
+                session.set(clean=False, **trackdata)
+
+            sessions.append(session)
 
-            i += 1
+        # Save all files in parallel
+        for commit in commitMany(sessions):
+            if commit["error"]:
+                print("Could not save file: %s" % str(commit["filename"]))
+            else:
+                i += 1
 
         status = "Saved %d/%d files!" % (i, len(self.files))
         if i == len(self.files):
@@ -476,6 +479,11 @@ def main(args):
         print("Filename is not a valid path: %s" % (args.filename,))
         return 2
 
+    if args.artworkSize:
+        setArtworkPolicy(ArtworkPolicy(maxSize=args.artworkSize, maxBytes=args.artworkBytes * 1024))
+    else:
+        setArtworkPolicy(None)
+
     if args.isAlbum:
         print("++++Album Mode++++")
         dirname = os.path.dirname(
@@ -570,6 +578,20 @@ if __name__ == "__main__":
         dest='query',
         help='Search with this query instead of artist/tile from id3 metadata from the mp3 file')
 
+    parser.add_argument(
+        '--artwork-size',
+        dest='artworkSize',
+        type=int,
+        default=1000,
+        help='Maximum width and height of the embedded artwork, 0 embeds the original')
+
+    parser.add_argument(
+        '--artwork-kb',
+        dest='artworkBytes',
+        type=int,
+        default=200,
+        help='Maximum size of the embedded artwork in KiB')
+
     parser.add_argument(
         'filename',
         nargs='?',
@@ -0,0 +1,291 @@
+#! python3
+"""Local stand-in for the iTunes API and the artwork server.
+
+Serves recorded responses ("cassettes") from a directory with configurable
+latency and error rate, or records real responses in --record mode. Error
+responses of the real servers (e.g. 403, 429, 503) are passed on but only
+recorded with --record-errors, such cassettes are marked with "error": true.
+
+Point itunesapi at it with
+    itunesapi.setBaseUrl("http://127.0.0.1:8765", "http://127.0.0.1:8765/artwork")
+or with the environment variables
+    ITUNESAPI_BASE_URL=http://127.0.0.1:8765
+    ITUNESAPI_ARTWORK_URL=http://127.0.0.1:8765/artwork
+"""
+import os
+import argparse
+import hashlib
+import gzip
+import json
+import random
+import threading
+import time
+import urllib.parse
+import urllib.error
+import http.server
+
+from itunesapi import ConnectionPool
+
+__version__ = "1.8"
+
+
+def cassetteName(path, query):
+    # Parameter order does not matter, the same request always maps to the same file
+    params = sorted(urllib.parse.parse_qsl(query, keep_blank_values=True))
+    canonical = path + "?" + urllib.parse.urlencode(params)
+    endpoint = path.strip("/").split("/")[0] or "root"
+    return "%s-%s" % (endpoint, hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:20])
+
+
+class CassetteStore:
+    """Recorded responses stored as <name>.json (status, headers) and <name>.body"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def load(self, name):
+        filename = os.path.join(self.directory, name)
+        if not os.path.exists(filename + ".json"):
+            return None
+        with open(filename + ".json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(filename + ".body", "rb") as f:
+            body = f.read()
+        return meta["status"], meta["headers"], body
+
+    def save(self, name, request, status, headers, body):
+        filename = os.path.join(self.directory, name)
+        with self._lock:
+            with open(filename + ".body", "wb") as f:
+                f.write(body)
+            with open(filename + ".json", "w", encoding="utf-8") as f:
+                json.dump({
+                    "request": request,
+                    "status": status,
+                    "headers": headers,
+                    "error": not 200 <= status < 300,
+                    "recorded": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=1)
+
+
+class StandinServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, latency=0.0, jitter=0.0, errorRate=0.0,
+                 errorStatus=503, record=False, recordErrors=False, compress=False,
+                 apiUpstream="https://itunes.apple.com",
+                 artworkUpstream="https://is1-ssl.mzstatic.com"):
+        super().__init__(address, StandinHandler)
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.errorStatus = errorStatus
+        self.record = record
+        self.recordErrors = recordErrors
+        self.compress = compress
+        self.apiUpstream = apiUpstream.rstrip("/")
+        self.artworkUpstream = artworkUpstream.rstrip("/")
+        self.quiet = False
+        self.pool = ConnectionPool()
+        self.stats = {"requests": 0, "served": 0, "recorded": 0,
+                      "missing": 0, "injectedErrors": 0, "upstreamErrors": 0}
+        self._statsLock = threading.Lock()
+
+    def count(self, key):
+        with self._statsLock:
+            self.stats[key] += 1
+
+    def upstreamUrl(self, path, query):
+        if path.startswith("/artwork/"):
+            url = self.artworkUpstream + path[len("/artwork"):]
+        else:
+            url = self.apiUpstream + path
+        return url + ("?" + query if query else "")
+
+    def fetchUpstream(self, path, query):
+        url = self.upstreamUrl(path, query)
+        try:
+            response, body = self.pool.request(url)
+            status = response.status
+            contentType = response.getheader("Content-Type", "application/octet-stream")
+        except urllib.error.HTTPError as e:
+            status, body = e.code, b""
+            headers = {"Content-Type": e.headers.get("Content-Type", "text/plain") if e.headers else "text/plain"}
+            if e.headers and e.headers.get("Retry-After"):
+                headers["Retry-After"] = e.headers["Retry-After"]
+            return status, headers, body
+        return status, {"Content-Type": contentType}, body
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "itunes_standin/" + __version__
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        parts = urllib.parse.urlsplit(self.path)
+
+        if parts.path == "/_stats":
+            with server._statsLock:
+                body = json.dumps(server.stats).encode("utf-8")
+            return self.respond(200, {"Content-Type": "application/json"}, body)
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if server.errorRate and random.random() < server.errorRate:
+            server.count("injectedErrors")
+            return self.respond(server.errorStatus, {
+                "Content-Type": "text/plain",
+                "Retry-After": "1"}, b"Injected error")
+
+        name = cassetteName(parts.path, parts.query)
+        cassette = server.store.load(name)
+        if cassette is None and server.record:
+            cassette = server.fetchUpstream(parts.path, parts.query)
+            if not 200 <= cassette[0] < 300 and not server.recordErrors:
+                # Throttled or failed upstream requests must not become permanent replays
+                server.count("upstreamErrors")
+                return self.respond(*cassette)
+            server.store.save(name, self.path, *cassette)
+            server.count("recorded")
+
+        if cassette is None:
+            server.count("missing")
+            return self.respond(404, {"Content-Type": "text/plain"},
+                                b"No cassette for this request")
+
+        server.count("served")
+        status, headers, body = cassette
+        if (server.compress and len(body) > 256
+                and "gzip" in self.headers.get("Accept-Encoding", "")
+                and not headers.get("Content-Type", "").startswith("image/")):
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+            body = gzip.compress(body, 6)
+        self.respond(status, headers, body)
+
+    def respond(self, status, headers, body):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main(args):
+    server = StandinServer(
+        (args.host, args.port),
+        CassetteStore(args.cassettes),
+        latency=args.latency / 1000.0,
+        jitter=args.jitter / 1000.0,
+        errorRate=args.errorRate,
+        errorStatus=args.errorStatus,
+        record=args.record,
+        recordErrors=args.recordErrors,
+        compress=args.compress,
+        apiUpstream=args.apiUpstream,
+        artworkUpstream=args.artworkUpstream)
+    server.quiet = args.quiet
+
+    base = "http://%s:%d" % server.server_address[0:2]
+    print("%s mode, cassettes in %s" % ("Record" if args.record else "Replay", args.cassettes))
+    print("ITUNESAPI_BASE_URL=%s" % base)
+    print("ITUNESAPI_ARTWORK_URL=%s/artwork" % base)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats))
+
+
+if __name__ == "__main__":
+    # Arguments
+    parser = argparse.ArgumentParser(
+        description='Local stand-in server for the iTunes API with recorded responses')
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='Interface to listen on')
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8765,
+        help='Port to listen on')
+    parser.add_argument(
+        '--cassettes',
+        default='cassettes',
+        help='Directory with the recorded responses')
+    parser.add_argument(
+        '--record',
+        dest='record',
+        action='store_const',
+        const=True,
+        default=False,
+        help='Forward unknown requests to the real servers and record the responses')
+    parser.add_argument(
+        '--record-errors',
+        dest='recordErrors',
+        action='store_const',
+        const=True,
+        default=False,
+        help='Also record error responses of the real servers (marked with "error": true)')
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help='Delay every response by this many milliseconds')
+    parser.add_argument(
+        '--jitter',
+        type=float,
+        default=0.0,
+        help='Add a random delay of up to this many milliseconds')
+    parser.add_argument(
+        '--error-rate',
+        dest='errorRate',
+        type=float,
+        default=0.0,
+        help='Fraction of requests that fail, e.g. 0.05')
+    parser.add_argument(
+        '--error-status',
+        dest='errorStatus',
+        type=int,
+        default=503,
+        help='HTTP status of the injected errors')
+    parser.add_argument(
+        '--gzip',
+        dest='compress',
+        action='store_const',
+        const=True,
+        default=False,
+        help='Send gzip compressed responses to clients that accept them')
+    parser.add_argument(
+        '--api-upstream',
+        dest='apiUpstream',
+        default='https://itunes.apple.com',
+        help='Real API server used in record mode')
+    parser.add_argument(
+        '--artwork-upstream',
+        dest='artworkUpstream',
+        default='https://is1-ssl.mzstatic.com',
+        help='Real artwork server used in record mode')
+    parser.add_argument(
+        '-q',
+        dest='quiet',
+        action='store_const',
+        const=True,
+        default=False,
+        help='Do not log every request')
+    args = parser.parse_args()
+
+    main(args)
@@ -1,134 +1,1546 @@
+import os
 import urllib.request
 import urllib.parse
+import urllib.error
+import http.client
 import json
+import time
+import sqlite3
+import threading
+import collections
+import collections.abc
+import concurrent.futures
+import asyncio
+import ssl
+import email.parser
+import weakref
+import random
+import email.utils
+import re
+import unicodedata
+import zlib
+import base64
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 __all__ = [
     "iTunesFindAlbum",
     "iTunesFindSong",
     "iTunesGetTracks",
-    "findAlbumArt"]
+    "iTunesGetTracksMany",
+    "iTunesGetTracksComplete",
+    "StoreIndex",
+    "setStoreIndex",
+    "getStoreIndex",
+    "iTunesIterAlbums",
+    "iTunesIterSongs",
+    "Prefetcher",
+    "Album",
+    "Track",
+    "jsonDefault",
+    "findAlbumArt",
+    "ResponseCache",
+    "MemoryCache",
+    "SqliteCache",
+    "baseUrls",
+    "setBaseUrl",
+    "setCache",
+    "QueryNormalizer",
+    "normalizeQuery",
+    "canonicalQuery",
+    "cleanQuery",
+    "queryStats",
+    "isKnownEmpty",
+    "knownEmptyCountries",
+    "getCache",
+    "ConnectionPool",
+    "getConnectionPool",
+    "fetch",
+    "fetchJson",
+    "fetchArtwork",
+    "saveArtwork",
+    "SingleFlight",
+    "getTransferStats",
+    "RateLimiter",
+    "setRateLimiter",
+    "getRateLimiter",
+    "iTunesFindAlbumAsync",
+    "iTunesFindSongAsync",
+    "iTunesGetTracksAsync",
+    "fetchAsync",
+    "fetchJsonAsync",
+    "fetchArtworkAsync"]
 
 __version__ = "1.8"
 
+# Base URLs of the API endpoints. "artwork" replaces the scheme and host of
+# artwork URLs, e.g. to use a local stand-in server (see itunes_standin.py)
+defaultApiUrl = "https://itunes.apple.com"
+baseUrls = {
+    "search": defaultApiUrl + "/search",
+    "lookup": defaultApiUrl + "/lookup",
+    "artwork": None}
+
+_unchanged = object()
+
+
+def setBaseUrl(api=_unchanged, artwork=_unchanged):
+    """Send search and lookup requests to `api` and artwork requests to `artwork`.
+
+    Only the arguments that are given are changed, None restores the real servers.
+    """
+    if api is not _unchanged:
+        api = (api or defaultApiUrl).rstrip("/")
+        baseUrls["search"] = api + "/search"
+        baseUrls["lookup"] = api + "/lookup"
+    if artwork is not _unchanged:
+        baseUrls["artwork"] = artwork.rstrip("/") if artwork else None
+
+
+if os.environ.get("ITUNESAPI_BASE_URL"):
+    setBaseUrl(os.environ["ITUNESAPI_BASE_URL"])
+if os.environ.get("ITUNESAPI_ARTWORK_URL"):
+    setBaseUrl(artwork=os.environ["ITUNESAPI_ARTWORK_URL"])
+
+
+class ResponseCache:
+    """Base class for caches of decoded API responses.
+
+    Entries expire after `ttl` seconds, at most `maxEntries` are kept and the
+    least recently used entries are evicted first. Responses without results
+    expire sooner, after `negativeTtl` seconds.
+    Subclasses implement _get(), _set() and clear().
+    """
+
+    def __init__(self, ttl=24 * 3600, maxEntries=1000, negativeTtl=None):
+        self.ttl = ttl
+        self.negativeTtl = ttl // 6 if negativeTtl is None else negativeTtl
+        self.maxEntries = maxEntries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def peek(self, key):
+        """Like get() but without counting a hit or miss"""
+        with self._lock:
+            return self._get(key, time.time())
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, time.time() + (self.ttl if ttl is None else ttl))
+
+    def setResponse(self, key, data):
+        """Store an API response, empty responses with the shorter negativeTtl"""
+        self.set(key, data, None if data.get('results') else self.negativeTtl)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+    def _get(self, key, now):
+        raise NotImplementedError
+
+    def _set(self, key, value, expires):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemoryCache(ResponseCache):
+    """In-process LRU cache, lost when the program exits"""
+
+    def __init__(self, ttl=3600, maxEntries=256, negativeTtl=600):
+        super().__init__(ttl, maxEntries, negativeTtl)
+        self._entries = collections.OrderedDict()
+
+    def _get(self, key, now):
+        if key not in self._entries:
+            return None
+        expires, value = self._entries[key]
+        if expires < now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteCache(ResponseCache):
+    """Persistent cache stored in a sqlite database file"""
+
+    def __init__(self, filename, ttl=7 * 24 * 3600, maxEntries=20000, negativeTtl=12 * 3600):
+        super().__init__(ttl, maxEntries, negativeTtl)
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.commit()
+
+    def _get(self, key, now):
+        row = self._db.execute(
+            "SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+            return None
+        self._db.execute(
+            "UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self._db.commit()
+        return json.loads(row[0])
+
+    def _set(self, key, value, expires):
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), expires, time.time()))
+        overflow = self._db.execute(
+            "SELECT COUNT(*) FROM responses").fetchone()[0] - self.maxEntries
+        if overflow > 0:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed LIMIT ?)", (overflow,))
+        self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+_cache = MemoryCache()
+
+
+def setCache(cache):
+    """Replace the response cache, None disables caching"""
+    global _cache
+    _cache = cache
+
+
+def getCache():
+    return _cache
+
+
+def cacheKey(endpoint, params):
+    return endpoint + "?" + "&".join("%s=%s" % (k, params[k]) for k in sorted(params))
+
+
+acceptEncoding = "gzip, deflate, br" if brotli is not None else "gzip, deflate"
+transferStats = {"wireBytes": 0, "decodedBytes": 0}
+_transferLock = threading.Lock()
+
+
+def getTransferStats():
+    """Bytes received over the network and bytes after decompression"""
+    with _transferLock:
+        return dict(transferStats)
+
+
+class _Decoder:
+    """Incremental decoder for the Content-Encoding of a response"""
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or "identity").strip().lower()
+        self.wireBytes = 0
+        self.decodedBytes = 0
+        if self.encoding in ("gzip", "x-gzip", "deflate"):
+            # 32 + MAX_WBITS detects gzip and zlib headers automatically
+            self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            self._feed = self._decompressor.decompress
+        elif self.encoding == "br" and brotli is not None:
+            self._decompressor = brotli.Decompressor()
+            self._feed = self._decompressor.process
+        elif self.encoding == "identity":
+            self._decompressor = None
+            self._feed = bytes
+        else:
+            raise ValueError("Unsupported Content-Encoding: %s" % self.encoding)
+
+    def feed(self, chunk):
+        try:
+            data = self._feed(chunk)
+        except zlib.error as e:
+            if self.encoding == "deflate" and self.wireBytes == 0:
+                # Raw deflate without zlib header, sent by some servers. Retry like urllib3 does
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                self._feed = self._decompressor.decompress
+                data = self._feedRaw(chunk)
+            else:
+                raise ValueError("Invalid %s encoded response: %s" % (self.encoding, e)) from e
+        self.wireBytes += len(chunk)
+        self.decodedBytes += len(data)
+        return data
+
+    def _feedRaw(self, chunk):
+        try:
+            return self._feed(chunk)
+        except zlib.error as e:
+            raise ValueError("Invalid %s encoded response: %s" % (self.encoding, e)) from e
+
+    def finish(self):
+        data = b""
+        if self._decompressor is not None and hasattr(self._decompressor, "flush"):
+            data = self._decompressor.flush()
+            self.decodedBytes += len(data)
+        with _transferLock:
+            transferStats["wireBytes"] += self.wireBytes
+            transferStats["decodedBytes"] += self.decodedBytes
+        return data
+
+
+class ConnectionPool:
+    """Keeps persistent HTTP(S) connections, at most `maxPerHost` per host.
+
+    Connections are checked out by one thread at a time and returned to the
+    pool after the response has been read completely. Compressed responses
+    are decompressed while they are read.
+
+    Proxies are taken from `proxies` or, like urlopen() does, from
+    urllib.request.getproxies() (HTTP(S)_PROXY, NO_PROXY, the Windows
+    registry). HTTPS requests go through the proxy with a CONNECT tunnel.
+    """
+
+    redirectCodes = (301, 302, 303, 307, 308)
+    maxRedirects = 5
+    chunkSize = 64 * 1024
+
+    def __init__(self, maxPerHost=4, timeout=30, proxies=None):
+        self.maxPerHost = maxPerHost
+        self.timeout = timeout
+        self.proxies = urllib.request.getproxies() if proxies is None else proxies
+        self._proxyOf = {}
+        self._idle = collections.defaultdict(list)
+        self._open = collections.Counter()
+        self._cond = threading.Condition()
+
+    def _checkout(self, key):
+        with self._cond:
+            while not self._idle[key] and self._open[key] >= self.maxPerHost:
+                self._cond.wait()
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+            self._open[key] += 1
+
+        scheme, host, port = key
+        proxy = self._proxy(key)
+        if proxy is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        else:
+            proxyHost, proxyPort, proxyHeaders = proxy
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(proxyHost, proxyPort, timeout=self.timeout)
+                conn.set_tunnel(host, port, headers=proxyHeaders)
+            else:
+                conn = http.client.HTTPConnection(proxyHost, proxyPort, timeout=self.timeout)
+        return conn, False
+
+    def _proxy(self, key):
+        """(host, port, headers) of the proxy for this host or None"""
+        if key not in self._proxyOf:
+            scheme, host, port = key
+            proxy = self.proxies.get(scheme)
+            if proxy and not self._bypass(host, port):
+                if "://" not in proxy:
+                    proxy = "http://" + proxy
+                parts = urllib.parse.urlsplit(proxy)
+                headers = {}
+                if parts.username is not None:
+                    credentials = "%s:%s" % (
+                        urllib.parse.unquote(parts.username), urllib.parse.unquote(parts.password or ""))
+                    headers["Proxy-Authorization"] = "Basic " + base64.b64encode(
+                        credentials.encode("utf-8")).decode("ascii")
+                self._proxyOf[key] = (parts.hostname, parts.port or 8080, headers)
+            else:
+                self._proxyOf[key] = None
+        return self._proxyOf[key]
+
+    def _bypass(self, host, port):
+        hostport = host if port is None else "%s:%d" % (host, port)
+        if "no" in self.proxies:
+            return bool(urllib.request.proxy_bypass_environment(hostport, self.proxies))
+        return bool(urllib.request.proxy_bypass(hostport))
+
+    def _checkin(self, key, conn, reuse=True):
+        with self._cond:
+            if reuse:
+                self._idle[key].append(conn)
+            else:
+                conn.close()
+                self._open[key] -= 1
+            self._cond.notify()
+
+    def _request(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        proxy = self._proxy(key)
+        if proxy is not None and parts.scheme == "http":
+            # A plain HTTP proxy expects the absolute URL
+            path = urllib.parse.urlunsplit((parts.scheme, parts.netloc, path, "", ""))
+            headers = dict(headers, **proxy[2])
+
+        while True:
+            conn, reused = self._checkout(key)
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                decoder = _Decoder(response.getheader("Content-Encoding"))
+                chunks = []
+                while True:
+                    chunk = response.read(self.chunkSize)
+                    if not chunk:
+                        break
+                    chunks.append(decoder.feed(chunk))
+                chunks.append(decoder.finish())
+                body = b"".join(chunks)
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+                self._checkin(key, conn, reuse=False)
+                if reused:
+                    # The server closed an idle connection, try again with a new one
+                    continue
+                raise
+            except BaseException:
+                self._checkin(key, conn, reuse=False)
+                raise
+            self._checkin(key, conn, reuse=not response.will_close)
+            return response, body
+
+    def request(self, url, headers=None):
+        """Returns (response, body) of a GET request, following redirects"""
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", "py_itunesart/%s" % __version__)
+        headers.setdefault("Accept-Encoding", acceptEncoding)
+        for _ in range(self.maxRedirects + 1):
+            response, body = self._request(url, headers)
+            if response.status in self.redirectCodes and response.getheader("Location"):
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, response.msg, None)
+            return response, body
+        raise urllib.error.HTTPError(
+            url, response.status, "Too many redirects", response.msg, None)
+
+    def close(self):
+        with self._cond:
+            for key, conns in self._idle.items():
+                for conn in conns:
+                    conn.close()
+                self._open[key] -= len(conns)
+                conns.clear()
+
+
+_pool = ConnectionPool()
+
+
+def getConnectionPool():
+    return _pool
 
-def __getArt(search, entity, country):
-    #url = 'http://ax.itunes.apple.com/WebObjects/MZStoreServices.woa/wa/wsSearch?term=%s&country=%s&entity=%s' % (urllib.parse.quote(search), urllib.parse.quote(country), urllib.parse.quote(entity))
-    url = 'https://itunes.apple.com/search?explicit=Yes&term=%s&country=%s&entity=%s' % (
-        urllib.parse.quote(search), urllib.parse.quote(country), urllib.parse.quote(entity))
 
-    with urllib.request.urlopen(url) as r:
-        data = json.loads(
-            r.read().decode(
-                r.info().get_param('charset') or 'utf-8'))
+def fetch(url, headers=None):
+    """Download url through the shared connection pool and return the body"""
+    return _pool.request(url, headers)[1]
 
-    return data
+
+def fetchJson(url):
+    response, body = _pool.request(url, {"Accept": "application/json"})
+    return json.loads(body.decode(response.msg.get_content_charset() or 'utf-8'))
+
+
+class SingleFlight:
+    """Runs only one call per key at a time.
+
+    Threads that ask for a key while a call for it is already running wait
+    for that call and share its result instead of doing the work again.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            future = self._running.get(key)
+            leader = future is None
+            if leader:
+                self.calls += 1
+                future = self._running[key] = concurrent.futures.Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._running[key]
+
+
+_inflight = SingleFlight()
+
+
+def fetchArtwork(url):
+    return _inflight.do("artwork:" + url, lambda: fetch(url))
+
+
+def saveArtwork(url, filename):
+    """Replacement for urllib.request.urlretrieve() that uses the connection pool"""
+    data = fetchArtwork(url)
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return filename
+
+
+class RateLimiter:
+    """Token bucket shared by all threads that limits requests to the API.
+
+    Throttling responses (403, 429, 503) are retried up to `maxRetries` times
+    with jittered exponential backoff or after the time the server asks for in
+    Retry-After. While backing off, all other requests wait as well.
+    """
+
+    throttleCodes = (403, 429, 503)
+
+    def __init__(self, requestsPerMinute=20, burst=None, maxRetries=5, backoffBase=2.0, backoffMax=120.0):
+        self.requestsPerMinute = requestsPerMinute
+        self.burst = burst or requestsPerMinute
+        self.maxRetries = maxRetries
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.requests = 0
+        self.throttledResponses = 0
+        self.throttledSeconds = 0.0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blockedUntil = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before sending"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated) * self.requestsPerMinute / 60.0)
+            self._updated = now
+            self._tokens -= 1
+            self.requests += 1
+            delay = max(0.0, -self._tokens * 60.0 / self.requestsPerMinute,
+                        self._blockedUntil - now)
+            self.throttledSeconds += delay
+            return delay
+
+    def backoff(self, attempt, retryAfter=None):
+        """Register a throttling response and return the seconds to wait"""
+        delay = None
+        if retryAfter:
+            try:
+                delay = float(retryAfter)
+            except ValueError:
+                try:
+                    delay = email.utils.parsedate_to_datetime(retryAfter).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
+        if delay is None:
+            delay = min(self.backoffMax, self.backoffBase * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+        delay = max(0.0, delay)
+        with self._lock:
+            self.throttledResponses += 1
+            self.throttledSeconds += delay
+            self._blockedUntil = max(self._blockedUntil, time.monotonic() + delay)
+        return delay
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "throttledResponses": self.throttledResponses,
+                "throttledSeconds": self.throttledSeconds}
+
+
+_rateLimiter = RateLimiter()
+
+
+def setRateLimiter(limiter):
+    """Replace the rate limiter for API requests, None disables limiting"""
+    global _rateLimiter
+    _rateLimiter = limiter
+
+
+def getRateLimiter():
+    return _rateLimiter
+
+
+def _fetchApi(url):
+    limiter = _rateLimiter
+    if limiter is None:
+        return fetchJson(url)
+    attempt = 0
+    while True:
+        time.sleep(limiter.reserve())
+        try:
+            return fetchJson(url)
+        except urllib.error.HTTPError as e:
+            if e.code not in limiter.throttleCodes or attempt >= limiter.maxRetries:
+                raise
+            time.sleep(limiter.backoff(attempt, e.headers.get("Retry-After")))
+            attempt += 1
+
+
+def _prepareRequest(endpoint, params):
+    url = '%s?%s' % (
+        baseUrls[endpoint], urllib.parse.urlencode(params, quote_via=urllib.parse.quote))
+    return cacheKey(endpoint, params), url
+
+
+def _request(endpoint, params):
+    key, url = _prepareRequest(endpoint, params)
+    cache = _cache
+    if cache is not None:
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+    def fetchAndStore():
+        data = _fetchApi(url)
+        if cache is not None:
+            cache.setResponse(key, data)
+        return data
+
+    return _inflight.do(key, fetchAndStore)
+
+
+class QueryNormalizer:
+    """Turns search queries into the term that is sent and used as cache key.
+
+    Case, hyphens, repeated whitespace and a " - Topic" suffix (from YouTube
+    channel names) do not change the results of the search API, so queries
+    that only differ in these share one request and cache entry. Accents and
+    other punctuation are kept, they can change the results, see canonical().
+    """
+
+    _topic = re.compile(r"\s+-\s+topic(?=\s+-\s+|\s*$)", re.IGNORECASE)
+    _apostrophes = re.compile(r"['\u2019`\u00b4]")
+    _punctuation = re.compile(r"[\W_]+")
+
+    def __init__(self):
+        self._variants = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def clean(self, query):
+        """The term that is sent to the API and used in the cache key"""
+        cleaned = " ".join(self._topic.sub("", query).replace("-", " ").split())
+        return unicodedata.normalize("NFC", cleaned).lower()
+
+    def canonical(self, query):
+        """Aggressive form for grouping, e.g. in the library index. Not sent to the API"""
+        cleaned = self.clean(query)
+        canonical = unicodedata.normalize("NFC", self._stripLatinAccents(cleaned)).casefold()
+        canonical = self._apostrophes.sub("", canonical)
+        canonical = self._punctuation.sub(" ", canonical).strip()
+        # A query that is only punctuation, e.g. "!!!", keeps its punctuation
+        return canonical or cleaned
+
+    def normalize(self, query):
+        """clean() and record the raw query in stats()"""
+        cleaned = self.clean(query)
+        with self._lock:
+            self._variants[cleaned].add(query)
+        return cleaned
+
+    @staticmethod
+    def _stripLatinAccents(text):
+        # Combining marks of other scripts change the letter, e.g. cyrillic \u0439 is not \u0438
+        result = []
+        latin = False
+        for char in unicodedata.normalize("NFKD", text):
+            if unicodedata.combining(char):
+                if latin:
+                    continue
+            else:
+                latin = unicodedata.name(char, "").startswith("LATIN ")
+            result.append(char)
+        return "".join(result)
+
+    def stats(self):
+        """Number of different raw queries per sent term"""
+        with self._lock:
+            return {canonical: len(raw) for canonical, raw in self._variants.items()}
+
+
+_normalizer = QueryNormalizer()
+
+
+def normalizeQuery(query):
+    """The search term that is sent and used in the cache key. Recorded in queryStats()"""
+    return _normalizer.normalize(query)
+
+
+def canonicalQuery(query):
+    """Canonical form of a search query without recording it in queryStats()"""
+    return _normalizer.canonical(query)
+
+
+def cleanQuery(query):
+    """Same as normalizeQuery() without recording it in queryStats()"""
+    return _normalizer.clean(query)
+
+
+def queryStats():
+    return _normalizer.stats()
+
+
+def _searchParams(search, entity, country, limit=None, offset=None):
+    params = {
+        "explicit": "Yes",
+        "term": normalizeQuery(search),
+        "country": country,
+        "entity": entity}
+    if limit is not None:
+        params["limit"] = int(limit)
+    if offset:
+        params["offset"] = int(offset)
+    return params
+
+
+def _lookupParams(collectionId, country):
+    return {
+        "id": str(collectionId),
+        "entity": "song",
+        "country": str(country)}
+
+
+def isKnownEmpty(search, entity, country, limit=None, offset=None):
+    """True if the cache remembers that this search had no results in this store"""
+    cache = _cache
+    if cache is None:
+        return False
+    data = cache.peek(_prepareRequest("search", _searchParams(search, entity, country, limit, offset))[0])
+    return data is not None and not data.get('results')
+
+
+def knownEmptyCountries(search, entity, countries, limit=None, offset=None):
+    return [cc for cc in countries if isKnownEmpty(search, entity, cc, limit, offset)]
+
+
+def __getArt(search, entity, country, limit=None, offset=None):
+    #url = 'http://ax.itunes.apple.com/WebObjects/MZStoreServices.woa/wa/wsSearch?term=%s&country=%s&entity=%s' % (urllib.parse.quote(search), urllib.parse.quote(country), urllib.parse.quote(entity))
+    return _request("search", _searchParams(search, entity, country, limit, offset))
 
 
 def __getTracks(collectionId, country):
     #url = 'http://ax.itunes.apple.com/WebObjects/MZStoreServices.woa/wa/wsLookup?id=%s&entity=song' % (str(collectionId))
-    url = 'https://itunes.apple.com/lookup?id=%s&entity=song&country=%s' % (
-        str(collectionId), str(country))
+    return _request("lookup", _lookupParams(collectionId, country))
+
+
+class _Record:
+    """Base class of the result records.
+
+    Records are read like the dicts that were returned before: result["name"],
+    "name" in result, result.get("name"), dict(result), ...
+    They are no dict instances though: use asDict() or
+    json.dumps(results, default=jsonDefault) to serialize them, and
+    isinstance(result, collections.abc.Mapping) instead of dict.
+    The artwork URL is only built when "image" or imageUrl() is accessed.
+    """
+
+    __slots__ = ("artworkUrl", "dimensions", "country", "_image")
+    _keys = ()
+
+    def imageUrl(self, width, height=None, suffix='bb'):
+        if height is None:
+            height = width
+        url = self.artworkUrl.replace(
+            "100x100bb.jpg",
+            "%dx%d%s.jpg" % (width, height, suffix))
+        if baseUrls["artwork"]:
+            parts = urllib.parse.urlsplit(url)
+            url = baseUrls["artwork"] + urllib.parse.urlunsplit(("", "", parts.path, parts.query, ""))
+        return url
+
+    @property
+    def image(self):
+        if self._image is not None:
+            return self._image
+        return self.imageUrl(*self.dimensions)
+
+    def asDict(self):
+        """A plain dict with the same keys and values"""
+        return dict(self.items())
 
-    with urllib.request.urlopen(url) as r:
-        data = json.loads(
-            r.read().decode(
-                r.info().get_param('charset') or 'utf-8'))
+    __json__ = asDict
 
-    return data
+    def keys(self):
+        if self.country is None:
+            return list(self._keys)
+        return list(self._keys) + ["country"]
 
+    def values(self):
+        return [getattr(self, key) for key in self.keys()]
 
-def iTunesFindAlbum(search, dimensions=(600, 600, 'bb'), country="us"):
-    data = __getArt(search, "album", country)
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
 
-    results = []
+    def get(self, key, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
 
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key == "image":
+            self._image = value
+        elif key in self._keys or key == "country":
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._keys or (key == "country" and self.country is not None)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (_Record, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, dict(self.items()))
+
+
+collections.abc.Mapping.register(_Record)
+
+
+def jsonDefault(obj):
+    """`default` for json.dump(s) that serializes Album and Track records"""
+    if hasattr(obj, "__json__"):
+        return obj.__json__()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+class Album(_Record):
+    __slots__ = ("collectionId", "artistId", "artist", "name", "genre",
+                 "date", "totalTracks", "publisher")
+    _keys = ("collectionId", "artistId", "artist", "name", "genre",
+             "date", "totalTracks", "publisher", "image")
+
+    def __init__(self, item, dimensions=(600, 600, 'bb')):
+        self.collectionId = item['collectionId']
+        self.artistId = item['artistId']
+        self.artist = item['artistName']
+        self.name = item['collectionName']
+        self.genre = item['primaryGenreName']
+        self.date = item.get('releaseDate')
+        self.totalTracks = item['trackCount']
+        self.publisher = item.get('copyright')
+        self.artworkUrl = item['artworkUrl100']
+        self.dimensions = dimensions
+        self.country = None
+        self._image = None
+
+
+class Track(_Record):
+    __slots__ = ("trackId", "collectionId", "name", "artist", "album",
+                 "albumArtist", "genre", "date", "track", "totalTracks",
+                 "disc", "totalDiscs")
+    _keys = ("trackId", "collectionId", "name", "artist", "album",
+             "albumArtist", "genre", "date", "track", "totalTracks",
+             "disc", "totalDiscs", "image")
+
+    def __init__(self, item, dimensions=(600, 600, 'bb')):
+        self.trackId = item['trackId']
+        self.collectionId = item['collectionId']
+        self.name = item['trackName']
+        self.artist = item['artistName']
+        self.album = item['collectionName']
+        self.albumArtist = item.get('collectionArtistName')
+        self.genre = item['primaryGenreName']
+        self.date = item.get('releaseDate')
+        self.track = item['trackNumber']
+        self.totalTracks = item['trackCount']
+        self.disc = item.get('discNumber')
+        self.totalDiscs = item.get('discCount')
+        self.artworkUrl = item['artworkUrl100']
+        self.dimensions = dimensions
+        self.country = None
+        self._image = None
+
+
+def _iterAlbums(data, dimensions):
     for item in data['results']:
+        yield Album(item, dimensions)
 
-        result = {
-            "collectionId": item['collectionId'],
-            "artistId": item['artistId'],
-            "artist": item['artistName'],
-            "name": item['collectionName'],
-            "genre": item['primaryGenreName'],
-            "date": item['releaseDate'] if 'releaseDate' in item else None,
-            "totalTracks": item['trackCount'],
-            "publisher": item['copyright'] if 'copyright' in item else None,
-            "image": item['artworkUrl100'].replace(
-                "100x100bb.jpg",
-                "%dx%d%s.jpg" %
-                dimensions)}
-        results.append(result)
 
+def _iterSongs(data, dimensions):
+    for item in data['results']:
+        if item['wrapperType'] == 'track':
+            yield Track(item, dimensions)
+
+
+def _parseAlbums(data, dimensions):
+    return list(_iterAlbums(data, dimensions))
+
+
+def _parseSongs(data, dimensions):
+    return list(_iterSongs(data, dimensions))
+
+
+def _parseTracks(data, dimensions):
+    results = [Track(item, dimensions) for item in data['results'] if item['wrapperType'] == 'track']
+    results.sort(key=lambda v: v.track)
     return results
 
 
-def iTunesFindSong(search, dimensions=(600, 600, 'bb'), country="us"):
+maxCountryWorkers = 4
+
+
+def _fanOut(func, countries, firstMatch=False, workers=None):
+    """Call func(country) for all countries concurrently.
+
+    Every result is tagged with the "country" it was found in. With
+    firstMatch=True the results of the first store that returns a non-empty
+    list are returned and the remaining requests are cancelled.
+    """
+    countries = list(countries)
+    if not countries:
+        return []
+    workers = min(workers or maxCountryWorkers, len(countries))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(func, cc): cc for cc in countries}
+        resultsByCountry = {}
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            cc = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            for result in results:
+                result["country"] = cc
+            if firstMatch and results:
+                return results
+            resultsByCountry[cc] = results
+        if error is not None and not any(resultsByCountry.values()):
+            raise error
+        return [result for cc in countries for result in resultsByCountry.get(cc, [])]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iTunesFindAlbum(search, dimensions=(600, 600, 'bb'), country="us", firstMatch=False, limit=None, offset=None):
+    # A list of countries searches all these stores concurrently
+    if not isinstance(country, str):
+        empty = knownEmptyCountries(search, "album", country, limit, offset)
+        return _fanOut(lambda cc: iTunesFindAlbum(search, dimensions, cc, limit=limit, offset=offset),
+                       [cc for cc in country if cc not in empty], firstMatch)
+
+    data = __getArt(search, "album", country, limit, offset)
+    return _parseAlbums(data, dimensions)
+
+
+def iTunesIterAlbums(search, dimensions=(600, 600, 'bb'), country="us", limit=None, offset=None):
+    """Like iTunesFindAlbum() but yields the albums one at a time"""
+    data = __getArt(search, "album", country, limit, offset)
+    return _iterAlbums(data, dimensions)
+
+
+def iTunesFindSong(search, dimensions=(600, 600, 'bb'), country="us", firstMatch=False, limit=None, offset=None):
+    if not isinstance(country, str):
+        empty = knownEmptyCountries(search, "song", country, limit, offset)
+        return _fanOut(lambda cc: iTunesFindSong(search, dimensions, cc, limit=limit, offset=offset),
+                       [cc for cc in country if cc not in empty], firstMatch)
+
     # If the search term is a collectionId (album id/song id) directly fetch the tracks
     # Otherwise, search for songs
     try:
         collectionId = int(search)
         tracks = iTunesGetTracks(collectionId, country=country)
-        return tracks
+        return tracks[offset or 0:][:limit]
     except ValueError:
         pass
 
-    data = __getArt(search, "song", country)
+    data = __getArt(search, "song", country, limit, offset)
+    return _parseSongs(data, dimensions)
 
-    results = []
 
-    for item in data['results']:
-        if item['wrapperType'] != 'track':
-            continue
-        result = {
-            "trackId": item['trackId'],
-            "collectionId": item['collectionId'],
-            "name": item['trackName'],
-            "artist": item['artistName'],
-            "album": item['collectionName'],
-            "albumArtist": item['collectionArtistName'] if 'collectionArtistName' in item else None,
-            "genre": item['primaryGenreName'],
-            "date": item['releaseDate'] if 'releaseDate' in item else None,
-            "track": item['trackNumber'],
-            "totalTracks": item['trackCount'],
-            "image": item['artworkUrl100'].replace(
-                "100x100bb.jpg",
-                "%dx%d%s.jpg" %
-                dimensions)}
-        results.append(result)
+def iTunesIterSongs(search, dimensions=(600, 600, 'bb'), country="us", limit=None, offset=None):
+    """Like iTunesFindSong() but yields the songs one at a time"""
+    try:
+        collectionId = int(search)
+        return iter(iTunesGetTracks(collectionId, country=country)[offset or 0:][:limit])
+    except ValueError:
+        pass
 
-    return results
+    data = __getArt(search, "song", country, limit, offset)
+    return _iterSongs(data, dimensions)
+
+
+class StoreIndex:
+    """Remembers in which country stores the full track list of an album is available.
+
+    For every collectionId the index keeps the album's trackCount and the
+    number of tracks that the lookup returned per store. The index can be
+    saved to a JSON file and merged with the files of other users. At most
+    `maxEntries` albums are kept, the least recently used are dropped first.
+    """
+
+    def __init__(self, filename=None, maxEntries=10000):
+        self.filename = filename
+        self.maxEntries = maxEntries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            self.merge(filename)
+
+    def record(self, collectionId, country, tracks, totalTracks=None):
+        with self._lock:
+            entry = self._entries.setdefault(str(collectionId), {"totalTracks": None, "stores": {}})
+            if totalTracks is not None:
+                entry["totalTracks"] = int(totalTracks)
+            entry["stores"][country] = int(tracks)
+            self._entries.move_to_end(str(collectionId))
+            self._trim()
+
+    def _entry(self, collectionId):
+        entry = self._entries.get(str(collectionId))
+        if entry is not None:
+            self._entries.move_to_end(str(collectionId))
+        return entry
+
+    def _trim(self):
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+
+    def recordResponse(self, data, country):
+        """Update the index from a lookup response"""
+        counts = collections.Counter(
+            item['collectionId'] for item in data['results'] if item.get('wrapperType') == 'track')
+        for item in data['results']:
+            if item.get('wrapperType') == 'collection':
+                self.record(item['collectionId'], country,
+                            counts[item['collectionId']], item.get('trackCount'))
+
+    def totalTracks(self, collectionId):
+        with self._lock:
+            return (self._entry(collectionId) or {}).get("totalTracks")
+
+    def completeStores(self, collectionId, totalTracks=None):
+        """Countries where all tracks of the album were found"""
+        with self._lock:
+            entry = self._entry(collectionId)
+            if entry is None:
+                return []
+            total = totalTracks if totalTracks is not None else entry["totalTracks"]
+            if total is None:
+                return []
+            return [cc for cc, tracks in entry["stores"].items() if tracks >= total]
+
+    def incompleteStores(self, collectionId, totalTracks=None):
+        with self._lock:
+            entry = self._entry(collectionId)
+            if entry is None:
+                return []
+            total = totalTracks if totalTracks is not None else entry["totalTracks"]
+            if total is None:
+                return []
+            return [cc for cc, tracks in entry["stores"].items() if tracks < total]
+
+    def export(self, filename=None):
+        filename = filename or self.filename
+        with self._lock:
+            data = json.dumps({"version": 1, "collections": self._entries}, indent=1)
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(data)
+
+    save = export
+
+    def merge(self, filename):
+        """Add the entries of an exported index file"""
+        with open(filename, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self._lock:
+            for collectionId, other in data.get("collections", {}).items():
+                entry = self._entries.setdefault(collectionId, {"totalTracks": None, "stores": {}})
+                if other.get("totalTracks") is not None:
+                    entry["totalTracks"] = other["totalTracks"]
+                for cc, tracks in other.get("stores", {}).items():
+                    entry["stores"][cc] = max(tracks, entry["stores"].get(cc, 0))
+            self._trim()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_storeIndex = StoreIndex()
+
+
+def setStoreIndex(index):
+    global _storeIndex
+    _storeIndex = index
+
+
+def getStoreIndex():
+    return _storeIndex
 
 
 def iTunesGetTracks(collectionId, country="us", dimensions=(600, 600, 'bb')):
     data = __getTracks(collectionId, country=country)
+    if _storeIndex is not None:
+        _storeIndex.recordResponse(data, country)
+    return _parseTracks(data, dimensions)
 
-    results = []
 
-    for item in data['results']:
-        if item['wrapperType'] == 'track':
-            result = {
-                "name": item["trackName"],
-                "track": item["trackNumber"],
-                "artist": item["artistName"],
-                "trackId": item["trackId"],
-                "disc" : item["discNumber"],
-                "totalDiscs" : item["discCount"],
-                "collectionId": item["collectionId"],
-                "image": item['artworkUrl100'].replace(
-                    "100x100bb.jpg",
-                    "%dx%d%s.jpg" %
-                    dimensions),
-                "album": item['collectionName'],
-                "albumArtist": item['collectionArtistName'] if 'collectionArtistName' in item else None,
-                "genre": item['primaryGenreName'],
-                "date": item['releaseDate'] if 'releaseDate' in item else None,
-                "totalTracks": item['trackCount']
-            }
-            results.append(result)
-
-    results.sort(key=lambda v: v["track"])
+def iTunesGetTracksComplete(collectionId, totalTracks=None, country="us", countries=(), dimensions=(600, 600, 'bb')):
+    """Get the full track list of an album from the first store that has all tracks.
+
+    Stores that the store index knows to have the full track list are tried
+    first, then `country`, then the other `countries` concurrently.
+    Returns (tracks, country). If no store has all tracks, the tracks from
+    `country` are returned.
+    """
+    index = _storeIndex
+
+    def complete(tracks):
+        # The lookup response stores the album's trackCount in the index
+        total = totalTracks
+        if total is None and index is not None:
+            total = index.totalTracks(collectionId)
+        return len(tracks) >= total if total is not None else bool(tracks)
+
+    def completeOrEmpty(cc):
+        tracks = iTunesGetTracks(collectionId, cc, dimensions)
+        return tracks if complete(tracks) else []
+
+    known = index.completeStores(collectionId, totalTracks) if index is not None else []
+    if known:
+        cc = country if country in known else known[0]
+        tracks = iTunesGetTracks(collectionId, cc, dimensions)
+        if complete(tracks):
+            return tracks, cc
+
+    tracks = iTunesGetTracks(collectionId, country, dimensions)
+    if complete(tracks):
+        return tracks, country
+
+    skip = set(index.incompleteStores(collectionId, totalTracks)) if index is not None else set()
+    others = [cc for cc in countries if cc != country and cc not in skip and cc not in known]
+    found = _fanOut(completeOrEmpty, others, firstMatch=True)
+    if found:
+        return found, found[0]['country']
+    return tracks, country
+
+lookupBatchSize = 20
+# Apple applies the limit to the songs of each id, not to the whole response
+lookupLimit = 200
+
+
+def iTunesGetTracksMany(collectionIds, country="us", dimensions=(600, 600, 'bb')):
+    """Get the tracks of several albums with as few lookup requests as possible.
+
+    Returns a dict {collectionId: [tracks sorted by track number]}
+    """
+    collectionIds = [int(collectionId) for collectionId in collectionIds]
+    cache = _cache
+    responses = {}
+    missing = []
+    for collectionId in dict.fromkeys(collectionIds):
+        data = None
+        if cache is not None:
+            data = cache.get(_prepareRequest("lookup", _lookupParams(collectionId, country))[0])
+        if data is None:
+            missing.append(collectionId)
+        else:
+            responses[collectionId] = data
+
+    for i in range(0, len(missing), lookupBatchSize):
+        batch = missing[i:i + lookupBatchSize]
+        # Only the split per-collection responses are cached, not the batch itself
+        data = _fetchApi(_prepareRequest("lookup", {
+            "id": ",".join(str(collectionId) for collectionId in batch),
+            "entity": "song",
+            "country": str(country),
+            "limit": lookupLimit})[1])
+
+        # Split the mixed results array into one response per collection
+        split = {collectionId: [] for collectionId in batch}
+        for item in data['results']:
+            if item.get('collectionId') in split:
+                split[item['collectionId']].append(item)
+
+        for collectionId, items in split.items():
+            wrapper = [item for item in items if item['wrapperType'] == 'collection']
+            tracks = len(items) - len(wrapper)
+            if tracks >= lookupLimit and (not wrapper or tracks < wrapper[0].get('trackCount', 0)):
+                # This album was cut off by the per-id limit, fetch it on its own
+                responses[collectionId] = __getTracks(collectionId, country)
+                continue
+            responses[collectionId] = {"resultCount": len(items), "results": items}
+            if cache is not None:
+                cache.setResponse(_prepareRequest("lookup", _lookupParams(collectionId, country))[0],
+                                  responses[collectionId])
+
+    if _storeIndex is not None:
+        for data in responses.values():
+            _storeIndex.recordResponse(data, country)
+
+    return {collectionId: _parseTracks(responses[collectionId], dimensions)
+            for collectionId in collectionIds}
+
+
+class Prefetcher:
+    """Downloads the track lists and artwork of likely selections in the background.
+
+    While the user picks one of the search results, prefetch() starts loading
+    the data of the first results on a small thread pool. tracks() and
+    artwork() return the prefetched data, or download it if it was not
+    prefetched. Track lists also end up in the response cache.
+    """
+
+    def __init__(self, workers=3):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # key -> (collectionId, future)
+        self._tracks = {}
+        self._artwork = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, albums, count=3, country="us", artworkSize=None, artwork=True, dimensions=(600, 600, 'bb')):
+        for album in list(albums)[:count]:
+            collectionId = album['collectionId']
+            with self._lock:
+                if (collectionId, country) not in self._tracks:
+                    self._tracks[(collectionId, country)] = (collectionId, self._executor.submit(
+                        iTunesGetTracks, collectionId, country, dimensions))
+                if artwork:
+                    url = album.imageUrl(artworkSize) if artworkSize else album['image']
+                    if url not in self._artwork:
+                        self._artwork[url] = (collectionId, self._executor.submit(fetchArtwork, url))
+
+    def _result(self, futures, key, func):
+        with self._lock:
+            _, future = futures.pop(key, (None, None))
+        if future is not None and not future.cancel():
+            try:
+                return future.result()
+            except Exception:
+                # Try again without the prefetcher
+                pass
+        return func()
+
+    def tracks(self, collectionId, country="us", dimensions=(600, 600, 'bb')):
+        return self._result(self._tracks, (collectionId, country),
+                            lambda: iTunesGetTracks(collectionId, country, dimensions))
+
+    def artwork(self, url):
+        return self._result(self._artwork, url, lambda: fetchArtwork(url))
+
+    def saveArtwork(self, url, filename):
+        data = self.artwork(url)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def cancel(self, keep=None):
+        """Cancel the prefetches that have not started yet, except for album `keep`.
+
+        Prefetches that are already running finish in the background and their
+        track lists stay in the response cache.
+        """
+        keepId = keep['collectionId'] if keep is not None else None
+        with self._lock:
+            for futures in (self._tracks, self._artwork):
+                for key, (collectionId, future) in list(futures.items()):
+                    if collectionId != keepId:
+                        future.cancel()
+                        del futures[key]
+
+    def close(self):
+        self.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+#
+# asyncio variants
+#
+
+asyncConcurrency = 8
+_asyncSemaphores = weakref.WeakKeyDictionary()
+
+
+def _asyncSemaphore():
+    # asyncio primitives belong to one event loop, keep one semaphore per loop
+    loop = asyncio.get_running_loop()
+    if loop not in _asyncSemaphores:
+        _asyncSemaphores[loop] = asyncio.Semaphore(asyncConcurrency)
+    return _asyncSemaphores[loop]
+
+
+_asyncInflight = weakref.WeakKeyDictionary()
+
+
+async def _singleFlightAsync(key, coroutineFunction):
+    # Concurrent callers with the same key await one shared task. The task is
+    # shielded so that one cancelled caller does not cancel it for the others.
+    running = _asyncInflight.setdefault(asyncio.get_running_loop(), {})
+    task = running.get(key)
+    if task is None:
+        task = running[key] = asyncio.ensure_future(coroutineFunction())
+        task.add_done_callback(lambda _: running.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _asyncReadChunks(reader, headers):
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # Skip trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            yield await reader.readexactly(size)
+            await reader.readline()
+    elif headers.get("Content-Length") is not None:
+        remaining = int(headers["Content-Length"])
+        while remaining > 0:
+            chunk = await reader.readexactly(min(remaining, ConnectionPool.chunkSize))
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = await reader.read(ConnectionPool.chunkSize)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def _asyncReadBody(reader, headers):
+    decoder = _Decoder(headers.get("Content-Encoding"))
+    chunks = [decoder.feed(chunk) async for chunk in _asyncReadChunks(reader, headers)]
+    chunks.append(decoder.finish())
+    return b"".join(chunks)
+
+
+async def _asyncGet(url, headers):
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == "https"
+    port = parts.port or (443 if https else 80)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, port,
+        ssl=ssl.create_default_context() if https else None)
+    try:
+        lines = ["GET %s HTTP/1.1" % path, "Host: %s" % parts.netloc, "Connection: close"]
+        lines += ["%s: %s" % item for item in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        statusLine, _, rawHeaders = head.partition("\r\n")
+        _, status, reason = (statusLine.split(" ", 2) + [""])[:3]
+        message = email.parser.Parser(
+            _class=http.client.HTTPMessage).parsestr(rawHeaders)
+        body = await _asyncReadBody(reader, message)
+    finally:
+        writer.close()
+    return int(status), reason.strip(), message, body
+
+
+async def fetchAsync(url, headers=None, timeout=30):
+    """Download url on the running event loop and return (headers, body).
+
+    At most `asyncConcurrency` downloads run at the same time per loop.
+    """
+    headers = dict(headers or {})
+    headers.setdefault("User-Agent", "py_itunesart/%s" % __version__)
+    headers.setdefault("Accept-Encoding", acceptEncoding)
+    async with _asyncSemaphore():
+        for _ in range(ConnectionPool.maxRedirects + 1):
+            status, reason, message, body = await asyncio.wait_for(
+                _asyncGet(url, headers), timeout)
+            if status in ConnectionPool.redirectCodes and message.get("Location"):
+                url = urllib.parse.urljoin(url, message["Location"])
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, reason, message, None)
+            return message, body
+    raise urllib.error.HTTPError(url, status, "Too many redirects", message, None)
+
+
+async def fetchJsonAsync(url, timeout=30):
+    message, body = await fetchAsync(url, {"Accept": "application/json"}, timeout)
+    return json.loads(body.decode(message.get_content_charset() or 'utf-8'))
+
+
+async def fetchArtworkAsync(url, timeout=30):
+    async def download():
+        return (await fetchAsync(url, timeout=timeout))[1]
+
+    return await _singleFlightAsync("artwork:" + url, download)
+
+
+async def _fetchApiAsync(url, timeout):
+    limiter = _rateLimiter
+    if limiter is None:
+        return await fetchJsonAsync(url, timeout)
+    attempt = 0
+    while True:
+        await asyncio.sleep(limiter.reserve())
+        try:
+            return await fetchJsonAsync(url, timeout)
+        except urllib.error.HTTPError as e:
+            if e.code not in limiter.throttleCodes or attempt >= limiter.maxRetries:
+                raise
+            await asyncio.sleep(limiter.backoff(attempt, e.headers.get("Retry-After")))
+            attempt += 1
+
+
+async def _requestAsync(endpoint, params, timeout):
+    key, url = _prepareRequest(endpoint, params)
+    cache = _cache
+    if cache is not None:
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+    async def fetchAndStore():
+        data = await _fetchApiAsync(url, timeout)
+        if cache is not None:
+            cache.setResponse(key, data)
+        return data
+
+    return await _singleFlightAsync(key, fetchAndStore)
+
+
+async def _fanOutAsync(func, countries, firstMatch):
+    tasks = {asyncio.ensure_future(func(cc)): cc for cc in countries}
+    resultsByCountry = {}
+    error = None
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                cc = tasks[task]
+                if task.exception() is not None:
+                    error = error or task.exception()
+                    continue
+                results = task.result()
+                for result in results:
+                    result["country"] = cc
+                if firstMatch and results:
+                    return results
+                resultsByCountry[cc] = results
+    finally:
+        for task in tasks:
+            task.cancel()
+    if error is not None and not any(resultsByCountry.values()):
+        raise error
+    return [result for cc in countries for result in resultsByCountry.get(cc, [])]
+
+
+async def iTunesFindAlbumAsync(search, dimensions=(600, 600, 'bb'), country="us", firstMatch=False, limit=None, offset=None, timeout=30):
+    if not isinstance(country, str):
+        empty = knownEmptyCountries(search, "album", country, limit, offset)
+        return await _fanOutAsync(
+            lambda cc: iTunesFindAlbumAsync(search, dimensions, cc, limit=limit, offset=offset, timeout=timeout),
+            [cc for cc in country if cc not in empty], firstMatch)
+
+    data = await _requestAsync("search", _searchParams(search, "album", country, limit, offset), timeout)
+    return _parseAlbums(data, dimensions)
+
+
+async def iTunesFindSongAsync(search, dimensions=(600, 600, 'bb'), country="us", firstMatch=False, limit=None, offset=None, timeout=30):
+    if not isinstance(country, str):
+        empty = knownEmptyCountries(search, "song", country, limit, offset)
+        return await _fanOutAsync(
+            lambda cc: iTunesFindSongAsync(search, dimensions, cc, limit=limit, offset=offset, timeout=timeout),
+            [cc for cc in country if cc not in empty], firstMatch)
+
+    try:
+        collectionId = int(search)
+        tracks = await iTunesGetTracksAsync(collectionId, country=country, timeout=timeout)
+        return tracks[offset or 0:][:limit]
+    except ValueError:
+        pass
+
+    data = await _requestAsync("search", _searchParams(search, "song", country, limit, offset), timeout)
+    return _parseSongs(data, dimensions)
+
+
+async def iTunesGetTracksAsync(collectionId, country="us", dimensions=(600, 600, 'bb'), timeout=30):
+    data = await _requestAsync("lookup", _lookupParams(collectionId, country), timeout)
+    if _storeIndex is not None:
+        _storeIndex.recordResponse(data, country)
+    return _parseTracks(data, dimensions)
 
-    return results
 
 #
 # Below for testing only
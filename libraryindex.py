@@ -0,0 +1,296 @@
+#! python3
+"""Incremental index of the tags in a music library.
+
+The tags of every .mp3/.m4a file are stored in a sqlite database together
+with the size, mtime and inode of the file. update() only parses files that
+changed since the last run, the queries run on the database without touching
+the files.
+
+    python libraryindex.py library.sqlite3 D:\\Music --untagged
+"""
+import os
+import sys
+import argparse
+import sqlite3
+import threading
+import time
+import concurrent.futures
+
+from fileutils import TrackMetadata, scanTags, artworkDigest, getAlbumInfoString
+from itunesapi import canonicalQuery
+
+__version__ = "1.8"
+
+__all__ = [
+    "LibraryIndex",
+    "audioExtensions"]
+
+audioExtensions = ('.mp3', '.m4a')
+
+_fields = TrackMetadata.__slots__[1:]
+
+
+class LibraryIndex:
+    """Tags of the files in a library stored in a sqlite database file"""
+
+    def __init__(self, filename, workers=4):
+        self.filename = filename
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, directory TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+            "type TEXT, %s, "
+            "artistKey TEXT, albumKey TEXT, artworkHash TEXT, failed INTEGER DEFAULT 0, indexed REAL)"
+            % ", ".join(_fields))
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS files_directory ON files (directory)")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS files_album ON files (artistKey, albumKey)")
+        self._db.commit()
+
+    def update(self, roots, progress=None):
+        """Index all audio files below the directories (or single files) in roots.
+
+        Only files with a different size, mtime or inode than in the index are
+        parsed, files that no longer exist are removed from the index. Roots
+        that do not exist (e.g. an unmounted drive) are skipped and keep their
+        entries, as do directories that could not be read.
+        Returns counts: {"files", "parsed", "unchanged", "removed", "failed", "skipped"}
+        """
+        if isinstance(roots, str):
+            roots = [roots]
+        stats = {"files": 0, "parsed": 0, "unchanged": 0, "removed": 0, "failed": 0, "skipped": 0}
+
+        for root in roots:
+            root = os.path.abspath(root)
+            if not os.path.exists(root):
+                stats["skipped"] += 1
+                continue
+            known = self._known(root)
+            changed = []
+            walked = set()
+            for path, stat in _walk(root, walked):
+                stats["files"] += 1
+                signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                if known.pop(path, None) == signature:
+                    stats["unchanged"] += 1
+                else:
+                    changed.append((path, signature))
+
+            # All rows of a root are written in one transaction
+            with self._lock, self._db:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    for i, row in enumerate(pool.map(_readFile, changed)):
+                        # Files that could not be parsed are stored too, so that they
+                        # are only tried again when they change
+                        stats["failed" if row["failed"] else "parsed"] += 1
+                        self._store(row)
+                        if progress:
+                            progress(i, len(changed), changed[i][0])
+
+                # Everything that was not found anymore in a directory that was
+                # read, or whose directory does not exist anymore
+                removed = [
+                    (path, ) for path in known
+                    if os.path.dirname(path) in walked or not os.path.isdir(os.path.dirname(path))]
+                self._db.executemany("DELETE FROM files WHERE path = ?", removed)
+            stats["removed"] += len(removed)
+
+        return stats
+
+    def _known(self, root):
+        if os.path.isfile(root):
+            rows = self._db.execute(
+                "SELECT path, size, mtime_ns, inode FROM files WHERE path = ?", (root, ))
+        else:
+            prefix = os.path.join(root, "")
+            rows = self._db.execute(
+                "SELECT path, size, mtime_ns, inode FROM files WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix))
+        return {row["path"]: (row["size"], row["mtime_ns"], row["inode"]) for row in rows}
+
+    def _store(self, row):
+        columns = list(row)
+        self._db.execute(
+            "INSERT OR REPLACE INTO files (%s) VALUES (%s)" % (
+                ", ".join(columns), ", ".join("?" * len(columns))),
+            [row[column] for column in columns])
+
+    def metadata(self, path):
+        """TrackMetadata of a file from the index, None if it is not indexed"""
+        row = self._db.execute(
+            "SELECT * FROM files WHERE path = ? AND NOT failed", (os.path.abspath(path), )).fetchone()
+        return _metadataOf(row) if row else None
+
+    def files(self, directory):
+        """Paths and TrackMetadata of the files in a directory, sorted by path"""
+        rows = self._db.execute(
+            "SELECT * FROM files WHERE directory = ? AND NOT failed ORDER BY path",
+            (os.path.abspath(directory), ))
+        return [(row["path"], _metadataOf(row)) for row in rows]
+
+    def albums(self, untagged=False):
+        """One entry per directory with the most common artist and album in it.
+
+        With untagged=True only directories with files that have no iTunes
+        album id, i.e. were not tagged by setStuff() yet.
+        """
+        query = (
+            "SELECT directory, COUNT(*) AS files, "
+            "SUM(itunesalbumid IS NOT NULL) AS tagged, "
+            "COUNT(DISTINCT artworkHash) AS covers, "
+            "MAX(totalTracks) AS totalTracks, "
+            "MIN(itunesalbumid) AS itunesalbumid "
+            "FROM files WHERE NOT failed GROUP BY directory")
+        if untagged:
+            query += " HAVING tagged < files"
+        result = []
+        for row in self._db.execute(query + " ORDER BY directory").fetchall():
+            album = dict(row)
+            common = self._db.execute(
+                "SELECT COALESCE(albumArtist, artist) AS artist, album, COUNT(*) AS n FROM files "
+                "WHERE directory = ? AND NOT failed GROUP BY artistKey, albumKey "
+                "ORDER BY albumKey != '' DESC, n DESC LIMIT 1",
+                (row["directory"], )).fetchone()
+            album["artist"] = common["artist"]
+            album["album"] = common["album"]
+            result.append(album)
+        return result
+
+    def untaggedAlbums(self):
+        return self.albums(untagged=True)
+
+    def candidates(self, directory):
+        """Search queries for the iTunes API for the files in a directory.
+
+        One entry per distinct (artist, album) in the directory, most files first:
+        {"query": ..., "info": ..., "files": n}
+        """
+        directory = os.path.abspath(directory)
+        total = self._db.execute(
+            "SELECT COUNT(*) FROM files WHERE directory = ? AND NOT failed", (directory, )).fetchone()[0]
+        rows = self._db.execute(
+            "SELECT *, COUNT(*) AS n FROM files WHERE directory = ? AND albumKey != '' AND NOT failed "
+            "GROUP BY artistKey, albumKey ORDER BY n DESC", (directory, )).fetchall()
+        result = []
+        for row in rows:
+            info, guess = getAlbumInfoString(_metadataOf(row), range(total))
+            result.append({"query": guess, "info": info, "files": row["n"]})
+        return result
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+
+def _walk(root, walked):
+    if os.path.isfile(root):
+        walked.add(os.path.dirname(root))
+        if root.lower().endswith(audioExtensions):
+            yield root, os.stat(root)
+        return
+    # os.walk() skips directories that cannot be listed, they are not added to walked
+    for directory, dirs, files in os.walk(root):
+        walked.add(directory)
+        for name in files:
+            if name.lower().endswith(audioExtensions):
+                path = os.path.join(directory, name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    pass
+
+
+def _readFile(job):
+    path, (size, mtime_ns, inode) = job
+    row = {
+        "path": path,
+        "directory": os.path.dirname(path),
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "inode": inode,
+        "type": 'mp3' if path.lower().endswith('.mp3') else 'mp4',
+        "failed": 1,
+        "indexed": time.time()}
+    try:
+        tags = scanTags(path)
+    except BaseException:
+        return row
+    metadata = TrackMetadata.fromAudio(tags, row["type"])
+    row.update(metadata.asDict())
+    row.update({
+        # Not recorded in the query stats of itunesapi
+        "artistKey": canonicalQuery(metadata.albumArtist or metadata.artist or ""),
+        "albumKey": canonicalQuery(metadata.album or ""),
+        "artworkHash": artworkDigest(tags),
+        "failed": 0})
+    return row
+
+
+def _metadataOf(row):
+    return TrackMetadata(row["type"], **{name: row[name] for name in _fields})
+
+
+def main(args):
+    index = LibraryIndex(args.database, workers=args.workers)
+    if args.roots:
+        start = time.time()
+        stats = index.update(args.roots)
+        print("%d files, %d parsed, %d unchanged, %d removed, %d failed in %.1fs" % (
+            stats["files"], stats["parsed"], stats["unchanged"], stats["removed"],
+            stats["failed"], time.time() - start))
+        if stats["skipped"]:
+            print("%d directories not found, their entries were kept" % stats["skipped"])
+
+    if args.albums or args.untagged:
+        for album in index.albums(untagged=args.untagged):
+            print("%s\n    %s - %s (%d files, %d tagged, %d covers)" % (
+                album["directory"], album["artist"] or "?", album["album"] or "?",
+                album["files"], album["tagged"], album["covers"]))
+            if args.untagged:
+                for candidate in index.candidates(album["directory"])[0:3]:
+                    print("    ? %s" % candidate["query"])
+
+    index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    # Arguments
+    parser = argparse.ArgumentParser(
+        description='Index the tags of a music library in a sqlite database')
+    parser.add_argument(
+        'database',
+        help='The sqlite database file')
+    parser.add_argument(
+        'roots',
+        nargs='*',
+        help='Directories to index, only changed files are parsed again')
+    parser.add_argument(
+        '--albums',
+        dest='albums',
+        action='store_const',
+        const=True,
+        default=False,
+        help='List all albums (directories)')
+    parser.add_argument(
+        '--untagged',
+        dest='untagged',
+        action='store_const',
+        const=True,
+        default=False,
+        help='List albums with files that have no iTunes album id and search queries for them')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Number of files that are parsed at the same time')
+    args = parser.parse_args()
+
+    sys.exit(main(args))